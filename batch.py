@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import io
+import os
+import random
+import time
+import pandas as pd
+import simpy
+
+from logger import Logger
+from builder import create_sim_graph
+from cameo_sim import CONFIG_FILE, load_config
+from invalid_model_error import InvalidModelError
+from sim import loop_create_runs_process
+from validate import check_sim_graph
+from xml_loader import load_model_data
+import psf
+
+# Batch mode: simulates every model export in a directory (or matching a glob) in parallel,
+# and writes one table comparing them. Useful for regression checks across model versions.
+# Run with "python batch.py <directory or glob>"; run settings default to config.json.
+# Activity names default to the config's main_activity_name; set others per file with a
+# "batch" section in config.json, ex: {"activities": {"variant_b.xml": "OtherActivity"}, "workers": 4}
+# Every model gets the same seed, so differences between models aren't just noise.
+
+time_for_names = int(time.time())
+
+
+def simulate_model(xmlfile, activity_name, num_runs, time_between_runs, seed, write_results, psf_coefficients=None):
+    """Parses, checks and simulates one model in a worker process.
+       Returns a row of the comparison table; a bad model gives a row with its error instead of raising"""
+    name = os.path.basename(xmlfile)
+    row = {'model': name, 'activity': activity_name, 'status': 'ok', 'error': None}
+    stem = os.path.splitext(name)[0]
+    try:
+        start = time.time()
+        env = simpy.Environment()
+        if write_results:
+            logger = Logger(env, Logger.LOG_FILE, f'Results/Results_Batch_{stem}_{time_for_names}.xlsx',
+                            out_file=f'Results/Log_Batch_{stem}_{time_for_names}.txt')
+        else:
+            # Nothing is written; the comparison row only needs what the logger keeps in memory
+            logger = Logger(env, Logger.LOG_FILE, '', out_file=os.devnull)
+            logger.log_sim_events = False
+        with contextlib.redirect_stdout(io.StringIO()):
+            node_info_dict, edge_info_list, actor_infos, sub_activity_infos = load_model_data(xmlfile, activity_name)
+            row['parse_seconds'] = time.time()-start
+            node_dict, edge_list, start_node, actor_dict = create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos, sub_activity_infos,
+                                                                            psf_table=psf.create_psf_table(psf_coefficients))
+            warnings = check_sim_graph(node_dict, start_node, activity_name)
+        row['nodes'] = len(node_dict)
+        row['warnings'] = len(warnings)
+        start = time.time()
+        if seed is not None:
+            random.seed(seed)
+        env.process(loop_create_runs_process(env, logger, start_node, num_runs, time_between_runs))
+        env.run()
+        row['sim_seconds'] = time.time()-start
+        if write_results:
+            logger.log_final_stats()
+    except InvalidModelError as e:
+        row.update({'status': 'invalid model', 'error': str(e)})
+        return row
+    except Exception as e:
+        row.update({'status': 'error', 'error': f'{type(e).__name__}: {e}'})
+        return row
+    times = logger.run_time_sketch.summary()
+    row['runs_finished'] = times['count']
+    row['runs_failed'] = sum(1 for s in logger.summary_stats if s['failed'])
+    for stat in ['mean', 'min', 'p50', 'p95', 'p99', 'max']:
+        row[f'time_{stat}'] = times[stat]
+    return row
+
+
+def find_models(path):
+    """Model files in a directory, or matching a glob"""
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.xml')
+    return sorted(glob.glob(path))
+
+
+def run_batch(xmlfiles, activities, default_activity, num_runs, time_between_runs, seed=None, workers=None, write_results=False,
+              psf_coefficients=None):
+    """Simulates every model in parallel. Returns the comparison table, in the order the files were given"""
+    rows = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {}
+        for xmlfile in xmlfiles:
+            activity_name = activities.get(os.path.basename(xmlfile), default_activity)
+            future = pool.submit(simulate_model, xmlfile, activity_name, num_runs, time_between_runs, seed, write_results, psf_coefficients)
+            futures[future] = xmlfile
+        for future in concurrent.futures.as_completed(futures):
+            xmlfile = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:  # the worker itself died
+                row = {'model': os.path.basename(xmlfile), 'activity': None, 'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+            rows[xmlfile] = row
+            print(f"[{len(rows)}/{len(xmlfiles)}] {row['model']}: {row['status']}" + (f" ({row['error']})" if row['error'] else ''))
+    return pd.DataFrame([rows[f] for f in xmlfiles])
+
+
+def main():
+    xmlfile, activity_diagram_name, time_between_runs, num_runs, options = load_config(CONFIG_FILE)
+    batch_options = options['batch'] if options['batch'] is not None else {}
+    parser = argparse.ArgumentParser(description='Simulates a directory of model exports and compares them')
+    parser.add_argument('models', help='directory of .xml exports, or a glob (ex: "exports/*_v2.xml")')
+    parser.add_argument('--runs', type=int, default=num_runs, help='runs per model (default from config.json)')
+    parser.add_argument('--workers', type=int, default=batch_options.get('workers'), help='parallel processes (default: one per CPU)')
+    parser.add_argument('--results-files', action='store_true', help='also write the usual log and results file for every model')
+    args = parser.parse_args()
+    xmlfiles = find_models(args.models)
+    if len(xmlfiles) == 0:
+        raise Exception(f'No model files found at {args.models}')
+    os.makedirs('Results', exist_ok=True)
+    print(f'Simulating {len(xmlfiles)} models, {args.runs} runs each')
+    table = run_batch(xmlfiles, batch_options.get('activities', {}), activity_diagram_name, args.runs, time_between_runs,
+                      options['seed'], args.workers, args.results_files, psf.load_coefficients(options['psf']))
+    out_file = f'Results/Batch_{time_for_names}.xlsx'
+    table.to_excel(out_file, sheet_name='Comparison', index=False)
+    pd.set_option('display.width', 200)
+    print(table.drop(columns=['error']).to_string(index=False))
+    print(f'Comparison table written to {out_file}')
+
+
+if __name__ == "__main__":
+    main()
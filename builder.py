@@ -1,5 +1,6 @@
 import nodes
 import edge
+import psf
 from invalid_model_error import InvalidModelError
 class Actor:
     """Represents an actor as defined in sysml. Holds enviromental information."""
@@ -7,14 +8,43 @@ class Actor:
         self.id = id
         self.name = name
         self.perv_env = perf_env
+        self.psf_tables = []
+        
+    def register_psf_table(self, psf_table):
+        """Registers a table caching values derived from this actor's enviroment"""
+        if psf_table not in self.psf_tables:
+            self.psf_tables.append(psf_table)
+            
+    def set_env(self, attrib, value):
+        """Changes an enviroment value (ex: during a sweep), invalidating any cached PSF values"""
+        self.perv_env[attrib] = value
+        for psf_table in self.psf_tables:
+            psf_table.invalidate(self)
+        
+        
+class ActivityTemplate:
+    """The compiled graph of a sub-activity. Built once per activity, and shared
+       (never copied) by every CallActivityNode that calls it"""
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.node_dict = {}
+        self.edge_list = []
+        self.start_node = None
+        
 
-def create_node_object(node_info, env, logger, actor=None):
+def create_node_object(node_info, env, logger, actor=None, templates=None):
     """Handles creating the correct node based on the type"""
+    if templates is None:
+        templates = {}
     n_name = node_info['name']
     n_id = node_info['id']
     n_type = node_info['type']
     if n_type == 'uml:CallBehaviorAction':
-        if node_info['time_type'] == 'Uniform_Completion_Time':
+        if node_info.get('called_activity_id') in templates:
+            print(f'Making CallActivityNode from {n_name}')
+            return nodes.CallActivityNode(env, logger, n_name, n_id, templates[node_info['called_activity_id']], actor)
+        elif node_info['time_type'] == 'Uniform_Completion_Time':
             print(f'Making UniformTimeNode from {n_name}')
             return nodes.UniformTimeNode(env, logger, n_name, n_id, node_info['perf'], actor, node_info['Min'], node_info['Max'])
         elif node_info['time_type'] == 'Static_Completion_Time':
@@ -51,22 +81,62 @@ def create_node_object(node_info, env, logger, actor=None):
         raise Exception(f'Unknown node type ({n_type}) Encountered.')
     
 
-def create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos):
-    """Takes in information from the xml loader, and assembles nodes and edges and connects them"""
+def apply_performance_settings(node, node_info, psf_table, importance_sampler=None):
+    """Sets up the failure chance and PSF adjustment of a performance action"""
+    node.fail_chance = node_info.get('Failure_Probability', 0)
+    node.importance_sampler = importance_sampler
+    if str(node_info.get('PerformanceEnable')).lower() == 'true':
+        print(f'Enabling PSFs for {node.name}')
+        node.set_psf_table(psf_table)
+
+
+def build_node(node_info, env, logger, actor_dict, templates, psf_table, importance_sampler=None, sensitivity_analyzer=None):
+    """Creates a single node, with all of its settings applied but no connections yet"""
+    if node_info['actor_id'] is None:
+        actor = None
+    else:
+        actor = actor_dict[node_info['actor_id']]
+    node = create_node_object(node_info, env, logger, actor, templates)
+    node.sensitivity_analyzer = sensitivity_analyzer
+    if isinstance(node, nodes.PerformanceActivity):
+        apply_performance_settings(node, node_info, psf_table, importance_sampler)
+    return node
+
+
+def build_edge(edge_info, env, logger):
+    """Creates a single edge, not yet connected to any nodes"""
+    if edge_info['type'] == 'basic':
+        new_edge = edge.Edge(env, logger, edge_info['name'], edge_info['id'], edge_info['probability'])
+    elif edge_info['type'] == 'signal':
+        new_edge = edge.SignalEdge(env, logger, edge_info['name'], edge_info['id'], edge_info['probability'])
+    else:
+        raise InvalidModelError(f"Unknown edge type {edge_info['type']}")
+    print(f'Added {type(new_edge).__name__}: {edge_info["name"]}')
+    if edge_info['probability'] != None:
+        print('    Probability:', edge_info['probability'])
+    return new_edge
+
+
+def label_call_sites(node_dict):
+    """Gives call nodes that share a name within an activity (ex: unnamed actions calling the same activity,
+       which are all named after it) a label including their id, so their results can be told apart"""
+    call_nodes = {}
+    for node in node_dict.values():
+        if isinstance(node, nodes.CallActivityNode):
+            call_nodes.setdefault(node.name, []).append(node)
+    for name, same_name in call_nodes.items():
+        for node in same_name:
+            node.label = name if len(same_name) == 1 else f'{name} ({node.id})'
+
+
+def connect_graph(env, logger, node_info_dict, edge_info_list, actor_dict, templates, psf_table, importance_sampler=None, sensitivity_analyzer=None):
+    """Creates the nodes and edges of a single activity and connects them.
+       Returns the node dict, edge list, and the activity's InitialNode"""
     # Create nodes with no connections for now
-    print('----- Setting up SimGraph... -----')
     node_dict = {}
-    actor_dict = {}
-    for actor_id in actor_infos:
-        actor_dict[actor_id] = Actor(actor_id, actor_infos[actor_id]['name'], actor_infos[actor_id]['env'])
     start_node = None
     for n_id in node_info_dict:
-        # Find actor
-        if node_info_dict[n_id]['actor_id'] is None:
-            this_node_actor = None
-        else:
-            this_node_actor = actor_dict[node_info_dict[n_id]['actor_id']]
-        node_dict[n_id] = create_node_object(node_info_dict[n_id], env, logger, this_node_actor)
+        node_dict[n_id] = build_node(node_info_dict[n_id], env, logger, actor_dict, templates, psf_table, importance_sampler, sensitivity_analyzer)
         if node_info_dict[n_id]['type'] == 'uml:InitialNode':
             if start_node is None:
                 start_node = node_dict[n_id]
@@ -76,18 +146,70 @@ def create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos):
     # Connecting incoming nodes to them
     edge_list = []
     for e in edge_info_list:
-        if e['type'] == 'basic':
-            new_edge = edge.Edge(env, logger, e['name'], e['id'], e['probability'])
-        elif e['type'] == 'signal':
-            new_edge = edge.SignalEdge(env, logger, e['name'], e['id'], e['probability'])
-        else:
-            raise InvalidModelError(f"Unknown edge type {e['type']}")
-        source_id = e['source_id']
-        target_id = e['target_id']
-        new_edge.set_next_node(node_dict[target_id])
-        node_dict[source_id].add_connection(new_edge)
+        new_edge = build_edge(e, env, logger)
+        new_edge.set_next_node(node_dict[e['target_id']])
+        node_dict[e['source_id']].add_connection(new_edge)
         edge_list.append(new_edge)
-        print(f'Added {type(new_edge).__name__}: {e["name"]}')
-        if e['probability'] != None:
-            print('    Probability:', e['probability'])
-    return node_dict, edge_list, start_node, actor_dict
\ No newline at end of file
+    label_call_sites(node_dict)
+    return node_dict, edge_list, start_node
+
+
+def create_actors(actor_infos):
+    """Creates the Actor objects, keyed by id"""
+    actor_dict = {}
+    for actor_id in actor_infos:
+        actor_dict[actor_id] = Actor(actor_id, actor_infos[actor_id]['name'], actor_infos[actor_id]['env'])
+    return actor_dict
+
+
+def create_activity_templates(env, logger, sub_activity_infos, actor_dict, psf_table, importance_sampler=None, sensitivity_analyzer=None):
+    """Compiles each sub-activity into a single shared template.
+       Templates are all created up front, so call nodes (even recursive ones) can refer to them before they are filled"""
+    templates = {}
+    for act_id in sub_activity_infos:
+        templates[act_id] = ActivityTemplate(act_id, sub_activity_infos[act_id]['name'])
+    for act_id in sub_activity_infos:
+        print(f'----- Setting up Sub-Activity {templates[act_id].name}... -----')
+        info = sub_activity_infos[act_id]
+        t = templates[act_id]
+        t.node_dict, t.edge_list, t.start_node = connect_graph(env, logger, info['node_info_dict'], info['edge_info_list'], actor_dict, templates, psf_table,
+                                                               importance_sampler, sensitivity_analyzer)
+        if t.start_node is None:
+            raise InvalidModelError(f"Sub-activity {t.name} has no InitialNode.")
+    return templates
+
+
+def collect_all_nodes(node_dict):
+    """All nodes of the graph by id, including the nodes of every sub-activity it calls"""
+    all_nodes = dict(node_dict)
+    to_check = list(node_dict.values())
+    while len(to_check) > 0:
+        node = to_check.pop()
+        if isinstance(node, nodes.CallActivityNode):
+            for n_id, sub_node in node.template.node_dict.items():
+                if n_id not in all_nodes:
+                    all_nodes[n_id] = sub_node
+                    to_check.append(sub_node)
+    return all_nodes
+
+
+def create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos, sub_activity_infos=None, psf_table=None, importance_sampler=None,
+                     sensitivity_analyzer=None):
+    """Takes in information from the xml loader, and assembles nodes and edges and connects them.
+       Sub-activities are compiled once each into templates, shared by all of their call sites.
+       PSF multipliers of every performance action are precomputed into psf_table (by default one that adjusts nothing).
+       If an importance_sampler is given, action failures are drawn from its tilted chances (see rare_event.py).
+       If a sensitivity_analyzer is given, derivatives of completion time are collected (see sensitivity.py)"""
+    if sub_activity_infos is None:
+        sub_activity_infos = {}
+    if psf_table is None:
+        psf_table = psf.PSFTable()
+    print('----- Setting up SimGraph... -----')
+    actor_dict = create_actors(actor_infos)
+    templates = create_activity_templates(env, logger, sub_activity_infos, actor_dict, psf_table, importance_sampler, sensitivity_analyzer)
+    print('----- Setting up Main Activity... -----')
+    node_dict, edge_list, start_node = connect_graph(env, logger, node_info_dict, edge_info_list, actor_dict, templates, psf_table,
+                                                     importance_sampler, sensitivity_analyzer)
+    if len(psf_table.modifiers) == 0 and len(psf_table.table) > 0:
+        print('Some actions have Performance_Enable set, but no PSF coefficients are configured; their times and failure chances are not adjusted.')
+    return node_dict, edge_list, start_node, actor_dict
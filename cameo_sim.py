@@ -1,13 +1,25 @@
+import argparse
 import time
 import json
+import random
 import simpy
 
 from logger import Logger
-from builder import create_sim_graph
-from sim import start_sim
+from builder import create_sim_graph, collect_all_nodes
+from sim import start_sim, start_cached_sim
 from xml_loader import load_model_data
+from rare_event import ImportanceSampler
+from sensitivity import SensitivityAnalyzer
+from result_cache import ResultCache
+from event_trace import TraceWriter
+from validate import check_sim_graph
+from checkpoint import Checkpointer
+import psf
+import exec_token
 
 CONFIG_FILE = 'config.json'
+# Settings that may be left out of the config; each enables an extra mode
+OPTIONAL_SETTINGS = ['seed', 'importance_sampling', 'sensitivity_analysis', 'result_cache', 'watch', 'service', 'trace', 'checkpoint', 'batch', 'compact_history', 'psf']
 time_for_names = int(time.time())
 
 def load_config(config_file):
@@ -17,17 +29,86 @@ def load_config(config_file):
     act_name = data['main_activity_name']
     time_between_runs = data['time_between_runs']
     num_runs = data['number_of_runs']
-    return xmlfile, act_name, time_between_runs, num_runs
+    # Missing optional settings are None
+    options = {k: data.get(k) for k in OPTIONAL_SETTINGS}
+    return xmlfile, act_name, time_between_runs, num_runs, options
     
 def main():
+    parser = argparse.ArgumentParser(description='Runs the sim set up in config.json')
+    parser.add_argument('--resume', action='store_true', help='continue from the latest checkpoint (see "checkpoint" in config.json)')
+    args = parser.parse_args()
     env = simpy.Environment()
-    xmlfile, activity_diagram_name, time_between_runs, num_runs = load_config(CONFIG_FILE)
+    xmlfile, activity_diagram_name, time_between_runs, num_runs, options = load_config(CONFIG_FILE)
     log_file = f'Results/Log_{activity_diagram_name}_{time_for_names}.txt'
     results_file = f'Results/Results_{activity_diagram_name}_{time_for_names}.xlsx'
     logger = Logger(env, Logger.LOG_BOTH, results_file, out_file=log_file)
-    node_info_dict, edge_info_list, actor_infos = load_model_data(xmlfile, activity_diagram_name)
-    node_dict, edge_list, start_node, actor_dict = create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos)
-    start_sim(env, logger, start_node, num_runs, time_between_runs)
+    if options['trace'] is not None:
+        # Keys are TraceWriter's arguments, plus text_log to keep (default) or drop the per-event text log
+        trace_options = dict(options['trace'])
+        logger.log_sim_events = trace_options.pop('text_log', True)
+        # A resumed sim continues its trace; otherwise the trace starts over
+        logger.trace = TraceWriter(append=args.resume, **trace_options)
+    if options['compact_history']:
+        # Less memory per node visit, for models whose runs visit many nodes (ex: long loops)
+        exec_token.ExecToken.compact_history = True
+    node_info_dict, edge_info_list, actor_infos, sub_activity_infos = load_model_data(xmlfile, activity_diagram_name)
+    sampler = None
+    if options['importance_sampling'] is not None:
+        # Keys are ImportanceSampler's arguments
+        sampler = ImportanceSampler(**options['importance_sampling'])
+    analyzer = None
+    if options['sensitivity_analysis']:
+        analyzer = SensitivityAnalyzer()
+        logger.add_results_sheet('Sensitivity', analyzer.results)
+    # PSF adjustment is off unless coefficients are chosen in the config
+    psf_coefficients = psf.load_coefficients(options['psf'])
+    node_dict, edge_list, start_node, actor_dict = create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos, sub_activity_infos,
+                                                                    psf_table=psf.create_psf_table(psf_coefficients),
+                                                                    importance_sampler=sampler, sensitivity_analyzer=analyzer)
+    # Fail fast on model problems, before any runs are spent
+    check_sim_graph(node_dict, start_node, activity_diagram_name)
+    if options['seed'] is not None:
+        random.seed(options['seed'])
+    cache = None
+    if options['result_cache'] is not None:
+        if options['seed'] is None or sampler is not None or analyzer is not None:
+            print('The result cache needs a seed, and does not store importance sampling or sensitivity results; not using it.')
+        else:
+            # Keys are ResultCache's arguments
+            cache = ResultCache(**options['result_cache'])
+    checkpointer = None
+    if options['checkpoint'] is not None:
+        if cache is not None:
+            print('Cached experiments are not checkpointed; not using checkpoints.')
+        else:
+            # Keys are Checkpointer's path and interval
+            checkpoint_key = ResultCache.make_key(node_info_dict, edge_info_list, actor_infos, sub_activity_infos, activity_diagram_name,
+                                                  time_between_runs, options['seed'], options['importance_sampling'], options['sensitivity_analysis'],
+                                                  psf_coefficients)
+            checkpointer = Checkpointer(key=checkpoint_key, sampler=sampler, analyzer=analyzer, **options['checkpoint'])
+    elif args.resume:
+        raise Exception('--resume needs a "checkpoint" section in the config')
+    if checkpointer is not None:
+        first_run_id, start_time = 0, None
+        if args.resume:
+            first_run_id, start_time = checkpointer.resume(logger, collect_all_nodes(node_dict))
+        else:
+            checkpointer.start_new()
+        start_sim(env, logger, start_node, num_runs-first_run_id, time_between_runs, first_run_id, checkpointer, start_time)
+        # Finished; nothing left to resume
+        checkpointer.remove()
+    elif cache is None:
+        start_sim(env, logger, start_node, num_runs, time_between_runs)
+    else:
+        cache_key = ResultCache.make_key(node_info_dict, edge_info_list, actor_infos, sub_activity_infos,
+                                         activity_diagram_name, time_between_runs, options['seed'], psf_coefficients)
+        start_cached_sim(env, logger, start_node, num_runs, time_between_runs, cache, cache_key, options['seed'])
+    if sampler is not None:
+        sampler.log_estimate(logger, num_runs)
+    if analyzer is not None:
+        analyzer.log_results(logger)
+    if logger.trace is not None:
+        logger.trace.close()
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
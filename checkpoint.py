@@ -0,0 +1,160 @@
+import os
+import pickle
+import random
+import struct
+import time
+
+import exec_token
+
+# Checkpoints of a long sim, so it can be resumed after a crash or preemption.
+# Each run draws from its own generator, seeded when it starts (see sim.py), so a run's results only
+# depend on the global RNG state and sim time at its start. A checkpoint is taken at the last run
+# boundary before which every run has finished, even if later runs are in progress: it holds the results
+# of the runs before the boundary, and the RNG state and sim time from when the boundary run started.
+# Resuming starts again from the boundary run, redoing the runs that were in progress (or had finished
+# out of order), and gives the same results as never stopping.
+#
+# To keep each checkpoint cheap, results are not rewritten every time. Each checkpoint appends
+# only the runs finished since the last one to a journal file, then atomically replaces a small
+# state file that records how much of the journal is valid.
+# The text log and event trace are only appended to, so runs after the last checkpoint appear
+# in them twice after a resume.
+
+LENGTH = struct.Struct('<Q')
+
+
+class Checkpointer:
+    """Saves sim progress to <path>.state and <path>.journal at most once every interval seconds.
+       key identifies the model and config; a checkpoint is only resumed with a matching key"""
+    def __init__(self, path, key, interval=60, sampler=None, analyzer=None):
+        self.state_path = path + '.state'
+        self.journal_path = path + '.journal'
+        self.key = key
+        self.interval = interval
+        self.sampler = sampler
+        self.analyzer = analyzer
+        self.last_save = time.time()
+        self.saved_run_id = 0  # runs before this are in the journal
+        # How many of logger.summary_stats have been looked at, so each save only goes through the new rows
+        self.summary_offset = 0
+        # Rows of runs past the last boundary that finished early, held until the boundary passes them
+        self.early_rows = {}
+        self.journal_size = 0
+        # (RNG state, sim time, next token id) from the start of each run not yet in the journal
+        self.run_starts = {}
+        self.warned_run_id = None
+
+    def start_new(self):
+        """Clears any old checkpoint, for a sim starting from the beginning"""
+        self.remove()
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+
+    def remove(self):
+        for path in (self.state_path, self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def maybe_save(self, env, logger, next_run_id):
+        """Called before each run starts. Saves if the interval has passed, up to the first unfinished run"""
+        self.run_starts[next_run_id] = (random.getstate(), env.now, exec_token.ExecToken.next_id)
+        if time.time()-self.last_save < self.interval:
+            return
+        boundary = self.saved_run_id
+        while boundary < next_run_id and boundary in logger.run_details:
+            boundary += 1
+        if boundary == self.saved_run_id:
+            if self.warned_run_id != boundary:
+                self.warned_run_id = boundary
+                logger.log(f'No checkpoint taken: run {boundary} is still going, so nothing new can be saved yet')
+            return
+        self.save(logger, boundary)
+
+    def save(self, logger, boundary):
+        """Saves every run before boundary; resuming starts again at the boundary run"""
+        run_ids = range(self.saved_run_id, boundary)
+        # Runs after the boundary that finished early are left out; they will be redone on resume
+        rows = [s for run_id, s in self.early_rows.items() if run_id < boundary]
+        for s in rows:
+            del self.early_rows[s['run_id']]
+        for s in logger.summary_stats[self.summary_offset:]:
+            if s['run_id'] < boundary:
+                rows.append(s)
+            else:
+                self.early_rows[s['run_id']] = s
+        self.summary_offset = len(logger.summary_stats)
+        delta = {'summary_stats': rows,
+                 'run_details': {r: logger.run_details[r] for r in run_ids}}
+        if self.sampler is not None:
+            delta['log_weights'] = {r: self.sampler.log_weights[r] for r in run_ids if r in self.sampler.log_weights}
+            delta['failed_runs'] = [r for r in run_ids if r in self.sampler.failed_runs]
+        if self.analyzer is not None:
+            delta['runs'] = {r: self.analyzer.runs[r] for r in run_ids if r in self.analyzer.runs}
+            delta['run_scores'] = {r: self.analyzer.run_scores[r] for r in run_ids if r in self.analyzer.run_scores}
+        data = pickle.dumps(delta)
+        with open(self.journal_path, 'ab') as f:
+            f.truncate(self.journal_size)  # drops anything left by a save that was cut short
+            f.write(LENGTH.pack(len(data)) + data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += LENGTH.size + len(data)
+        rng_state, sim_time, next_token_id = self.run_starts[boundary]
+        state = {'key': self.key,
+                 'journal_size': self.journal_size,
+                 'next_run_id': boundary,
+                 'sim_time': sim_time,
+                 'rng_state': rng_state,
+                 'next_token_id': next_token_id}
+        if self.analyzer is not None:
+            # Which parameters have been seen; the nodes themselves are looked up again on resume
+            state['analyzer_nodes'] = list(self.analyzer.nodes)
+            state['analyzer_edges'] = [(node.id, e.id) for node, e in self.analyzer.edges.values()]
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+        for run_id in run_ids:
+            del self.run_starts[run_id]
+        self.saved_run_id = boundary
+        self.last_save = time.time()
+        logger.log(f'Checkpoint saved before run {boundary}')
+
+    def resume(self, logger, all_nodes):
+        """Restores the latest checkpoint into the logger, sampler, analyzer and RNG.
+           all_nodes maps node ids to nodes, including those in sub-activities.
+           Returns (next run id, sim time to continue from)"""
+        if not os.path.exists(self.state_path):
+            raise Exception(f'No checkpoint to resume at {self.state_path}')
+        with open(self.state_path, 'rb') as f:
+            state = pickle.load(f)
+        if state['key'] != self.key:
+            raise Exception('The checkpoint was made with a different model or config; cannot resume from it')
+        with open(self.journal_path, 'rb+') as f:
+            f.truncate(state['journal_size'])
+            while f.tell() < state['journal_size']:
+                length = LENGTH.unpack(f.read(LENGTH.size))[0]
+                self.apply_delta(logger, pickle.loads(f.read(length)))
+        if self.analyzer is not None:
+            for node_id in state['analyzer_nodes']:
+                self.analyzer.nodes[node_id] = all_nodes[node_id]
+            for node_id, edge_id in state['analyzer_edges']:
+                node = all_nodes[node_id]
+                e = [e for e in node.out_edges if e.id == edge_id][0]
+                self.analyzer.edges[edge_id] = (node, e)
+        random.setstate(state['rng_state'])
+        exec_token.ExecToken.next_id = state['next_token_id']
+        self.journal_size = state['journal_size']
+        self.saved_run_id = state['next_run_id']
+        self.summary_offset = len(logger.summary_stats)
+        logger.log(f"Resumed from checkpoint: {state['next_run_id']} runs already done", log_time=False)
+        return state['next_run_id'], state['sim_time']
+
+    def apply_delta(self, logger, delta):
+        logger.load_runs(delta['summary_stats'], delta['run_details'])
+        if self.sampler is not None:
+            self.sampler.log_weights.update(delta['log_weights'])
+            self.sampler.failed_runs.update(delta['failed_runs'])
+        if self.analyzer is not None:
+            self.analyzer.runs.update(delta['runs'])
+            self.analyzer.run_scores.update(delta['run_scores'])
@@ -15,6 +15,10 @@ class Edge(object):
     def call_next_node(self, token):
         if self.next_node is None:
             raise Exception(f"Edge {self.name}'s next node called without one being set.")
+        if token.is_dropped():
+            # Another branch already ended this run (ex: an action failed), or the sub-activity call it is in
+            self.logger.log_sim_event(token.run_id, f"Token {token.id} dropped at edge {self.name}; its run or call has ended.")
+            return
         self.logger.log_sim_event(token.run_id, f"Edge {self.name} followed, calling next node {self.next_node.name}.")
         self.env.process(self.next_node.run(token))
         
@@ -28,5 +32,8 @@ class SignalEdge(Edge):
     def call_next_node(self, token):
         if self.next_node is None:
             raise Exception(f"Edge {self.name}'s next node called without one being set.")
+        if token.is_dropped():
+            self.logger.log_sim_event(token.run_id, f"Token {token.id} dropped at signal edge {self.name}; its run or call has ended.")
+            return
         self.logger.log_sim_event(token.run_id, f"SignalEdge {self.name} followed, Calling Acceptor {self.next_node.name}. TOKEN={token.id}")
         self.env.process(self.next_node.run(token))
\ No newline at end of file
@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+# Compact binary event trace, and an offline query tool for it.
+# Each sim starts a new trace file (a resumed sim appends to its own): a short header, then fixed width little-endian records of
+#   time (f8), duration (f8), run_id (u4), token_id (u4), node index (u4), event kind (u1), 3 pad bytes
+# Node indices refer to a string table in a sidecar file (<trace>.names), one JSON object per line.
+# Nodes inside sub-activities get one index per call path, like in the results file.
+# For node visits, time is when the node was entered; for run ends, duration is the run's total time.
+#
+# Query from the terminal with "python event_trace.py <trace file> [filters] [--group-by node|run]", ex:
+#   python event_trace.py Results/trace.bin --run 512 --node "Forked A"
+#   python event_trace.py Results/trace.bin --start 0 --end 1000 --group-by node
+
+MAGIC = b'MBSETRC1'
+RECORD = struct.Struct('<ddIIIB3x')
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('duration', '<f8'), ('run_id', '<u4'), ('token_id', '<u4'),
+                         ('node', '<u4'), ('kind', 'u1'), ('pad', 'V3')])
+HEADER = MAGIC + struct.pack('<I', RECORD.size)
+
+NODE_VISIT = 0
+ACTION_FAIL = 1
+RUN_START = 2
+RUN_END = 3
+RUN_FAIL = 4
+KIND_NAMES = ['node_visit', 'action_fail', 'run_start', 'run_end', 'run_fail']
+
+
+class TraceWriter:
+    """Writes trace records to a file, buffering them so writes happen in large blocks.
+       Any existing trace at path is replaced, unless append is set (ex: when resuming the sim that wrote it);
+       run ids restart with every sim, so traces of separate sims can't share a file"""
+    def __init__(self, path, buffer_bytes=1024*1024, append=False):
+        self.path = path
+        self.names_path = path + '.names'
+        self.buffer = bytearray()
+        self.buffer_bytes = buffer_bytes
+        if not append:
+            for p in (path, self.names_path):
+                if os.path.exists(p):
+                    os.remove(p)
+        # path id -> node index; continues the string table of an existing trace
+        self.node_indices = {}
+        if os.path.exists(self.names_path):
+            with open(self.names_path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.node_indices[tuple(entry['path_id'])] = entry['index']
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new_file:
+            self.file.write(HEADER)
+        self.names_file = open(self.names_path, 'a')
+
+    def node_index(self, path_id, name):
+        try:
+            return self.node_indices[path_id]
+        except KeyError:
+            index = len(self.node_indices)
+            self.node_indices[path_id] = index
+            self.names_file.write(json.dumps({'index': index, 'name': name, 'path_id': list(path_id)}) + '\n')
+            return index
+
+    def record(self, time, duration, run_id, token_id, node_index, kind):
+        self.buffer += RECORD.pack(time, duration, run_id, token_id, node_index, kind)
+        if len(self.buffer) >= self.buffer_bytes:
+            self.flush()
+
+    def record_visit(self, token, history, failed=False):
+        """Records a node visit, from the NodeHistory just added to the token"""
+        index = self.node_index(history.path_id, history.name)
+        kind = ACTION_FAIL if failed else NODE_VISIT
+        self.record(history.time_entered-history.time_elapsed, history.time_elapsed, token.run_id, token.id, index, kind)
+
+    def record_run_start(self, token, start_node):
+        index = self.node_index((start_node.id,), start_node.label)
+        self.record(token.creation_time, 0, token.run_id, token.id, index, RUN_START)
+
+    def record_run_end(self, token, end_node, end_time, failed):
+        path_id = tuple(c.call_node.id for c in token.call_infos) + (end_node.id,)
+        name = '/'.join([c.call_node.label for c in token.call_infos] + [end_node.label])
+        index = self.node_index(path_id, name)
+        kind = RUN_FAIL if failed else RUN_END
+        self.record(end_time, end_time-token.creation_time, token.run_id, token.id, index, kind)
+
+    def flush(self):
+        # Names first, so every record on disk has its name
+        self.names_file.flush()
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.names_file.close()
+
+
+class TraceReader:
+    """Memory maps a trace file, answering queries with vectorized scans.
+       Scans go a chunk at a time, so traces larger than memory can be queried"""
+    def __init__(self, path, chunk_records=8*1024*1024):
+        self.path = path
+        self.chunk_records = chunk_records
+        with open(path, 'rb') as f:
+            header = f.read(len(HEADER))
+        if header != HEADER:
+            raise Exception(f'{path} is not a trace file (or is from an incompatible version)')
+        # A writer that was killed may have left a partial record at the end; ignore it
+        num_records = (os.path.getsize(path)-len(HEADER)) // RECORD.size
+        if num_records > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=len(HEADER), shape=(num_records,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.names = {}
+        with open(path + '.names') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.names[entry['index']] = entry['name']
+        # For turning whole columns of indices into names at once
+        self.name_array = np.array([self.names[i] for i in range(len(self.names))], dtype=object)
+
+    def node_indices(self, name):
+        """Indices of every node with this name. Plain names also match the node at every sub-activity call site"""
+        return [i for i, n in self.names.items() if n == name or n.endswith('/' + name)]
+
+    def chunks(self):
+        for start in range(0, len(self.records), self.chunk_records):
+            yield self.records[start:start+self.chunk_records]
+
+    def chunk_mask(self, chunk, run=None, node=None, kind=None, start=None, end=None):
+        mask = np.ones(len(chunk), dtype=bool)
+        if run is not None:
+            mask &= chunk['run_id'] == run
+        if node is not None:
+            mask &= np.isin(chunk['node'], self.node_indices(node))
+        if kind is not None:
+            mask &= chunk['kind'] == KIND_NAMES.index(kind)
+        if start is not None:
+            mask &= chunk['time'] >= start
+        if end is not None:
+            mask &= chunk['time'] < end
+        return mask
+
+    def to_frame(self, records):
+        df = pd.DataFrame({'time': records['time'],
+                           'duration': records['duration'],
+                           'run_id': records['run_id'],
+                           'token_id': records['token_id'],
+                           'node': self.name_array[records['node']],
+                           'kind': np.array(KIND_NAMES)[records['kind']]})
+        return df
+
+    def filter(self, **filters):
+        """Every record matching the filters (run, node name, kind name, start/end time window), as a DataFrame"""
+        matches = [chunk[self.chunk_mask(chunk, **filters)] for chunk in self.chunks()]
+        if len(matches) == 0:
+            return self.to_frame(np.zeros(0, dtype=RECORD_DTYPE))
+        return self.to_frame(np.concatenate(matches))
+
+    def aggregate(self, by='node', kind='node_visit', **filters):
+        """Count and duration stats of matching records, grouped by node or run"""
+        if by not in ('node', 'run_id'):
+            raise Exception("Can only group by 'node' or 'run_id'")
+        parts = []
+        for chunk in self.chunks():
+            matched = chunk[self.chunk_mask(chunk, kind=kind, **filters)]
+            if len(matched) == 0:
+                continue
+            df = pd.DataFrame({by: matched[by], 'duration': matched['duration']})
+            parts.append(df.groupby(by)['duration'].agg(['count', 'sum', 'min', 'max']))
+        if len(parts) == 0:
+            return pd.DataFrame(columns=[by, 'count', 'total_duration', 'mean_duration', 'min_duration', 'max_duration'])
+        # Combine the per-chunk stats
+        combined = pd.concat(parts).groupby(level=0).agg({'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'})
+        result = pd.DataFrame({'count': combined['count'],
+                               'total_duration': combined['sum'],
+                               'mean_duration': combined['sum']/combined['count'],
+                               'min_duration': combined['min'],
+                               'max_duration': combined['max']})
+        result = result.reset_index()
+        if by == 'node':
+            result['node'] = self.name_array[result['node'].to_numpy()]
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query a binary sim trace')
+    parser.add_argument('trace_file')
+    parser.add_argument('--run', type=int, help='only this run id')
+    parser.add_argument('--node', help='only this node (by name)')
+    parser.add_argument('--kind', choices=KIND_NAMES, help='only this kind of event')
+    parser.add_argument('--start', type=float, help='only events at or after this time')
+    parser.add_argument('--end', type=float, help='only events before this time')
+    parser.add_argument('--group-by', choices=['node', 'run'], help='aggregate durations instead of listing events')
+    parser.add_argument('--limit', type=int, default=50, help='most events to list (default 50)')
+    args = parser.parse_args()
+    reader = TraceReader(args.trace_file)
+    filters = {'run': args.run, 'node': args.node, 'start': args.start, 'end': args.end}
+    pd.set_option('display.width', 200)
+    if args.group_by is not None:
+        by = 'run_id' if args.group_by == 'run' else 'node'
+        print(reader.aggregate(by=by, kind=args.kind if args.kind is not None else 'node_visit', **filters).to_string(index=False))
+    else:
+        df = reader.filter(kind=args.kind, **filters)
+        print(f'{len(df)} matching events' + (f' (showing first {args.limit})' if len(df) > args.limit else ''))
+        print(df.head(args.limit).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,37 @@
+import random
+from array import array
+
 # A token that passes information between exectuion events. 
 # Can be updated to hold information as needed
 # Ex of use: Fork makes a pair of sibilings that are each needed for the Join to complete
+# Tokens and histories are created in huge numbers, so these runtime classes use __slots__
+# (no per-object dict)
+
+
 class ExecToken:
     """Holds run-specific enviroment/state information."""
+    __slots__ = ('id', 'run_id', 'fork_infos', 'creation_time', 'node_history', 'call_infos', 'time_grads', 'run_info')
     next_id = 0
-    def __init__(self, creation_time, run_id, fork_infos=[], node_history=[]):
+    # If set, histories are kept in a HistoryStore instead of a list of NodeHistory objects
+    compact_history = False
+    def __init__(self, creation_time, run_id, fork_infos=None, node_history=None, call_infos=(), time_grads=None, run_info=None):
         # stores ids for fork/joins ""above"" the current level
         # A ""stack"" -- should be pushed and popped from
         self.id = ExecToken.next_id
         self.run_id = run_id
         ExecToken.next_id+=1
-        self.fork_infos = fork_infos
+        # Fresh lists for each token; a shared default list would collect the history of every run
+        self.fork_infos = fork_infos if fork_infos is not None else []
         self.creation_time = creation_time
-        self.node_history = node_history
+        self.node_history = node_history if node_history is not None else new_history()
+        # Sub-activity calls the token is currently inside of, outermost first.
+        # A tuple, so siblings from a fork can safely share it
+        self.call_infos = call_infos
+        # Derivatives of elapsed time with respect to node parameters along this token's path.
+        # Only used in sensitivity mode (see sensitivity.py)
+        self.time_grads = time_grads
+        # Shared by every token of the run; a new run gets a new one
+        self.run_info = run_info if run_info is not None else RunInfo()
         
     def spawn_children_for_fork(self, num_children):
         """Creates a list of child tokens, with same exec info as parent but parent added to stack"""
@@ -21,26 +40,169 @@ class ExecToken:
         new_fork_info = ForkInfo(self.id, num_children, self.node_history)
         new_fork_stack.append(new_fork_info)
         # New exec tokens have 0 visited forks, to be added to the parent count by join
-        return [ExecToken(self.creation_time, self.run_id, new_fork_stack, []) for _ in range(num_children)]
+        return [ExecToken(self.creation_time, self.run_id, new_fork_stack, new_history(), self.call_infos, self.copy_time_grads(), self.run_info)
+                for _ in range(num_children)]
         # The new nodes will have no history -- we combine their fresh histories with the parent in the join
         
+    def copy_time_grads(self):
+        """Each child of a fork follows its own path, so needs its own copy of the derivatives"""
+        if self.time_grads is None:
+            return None
+        return dict(self.time_grads)
+        
+    def full_history(self, fork_depth=0):
+        """This token's history, with the history from before each fork it is inside of (past fork_depth) put in front
+           (the same history a join would have combined, minus any siblings)"""
+        history = self.node_history
+        for fork_info in reversed(self.fork_infos[fork_depth:]):
+            history = fork_info.parent_node_history + history
+        return history
+        
+    def is_dropped(self):
+        """True once the token's run, or any sub-activity call it is inside of, has ended"""
+        if self.run_info.ended:
+            return True
+        for call_info in self.call_infos:
+            if call_info.ended:
+                return True
+        return False
+        
     # The run id is also importiant, but we can get that from self
     def log_node_history(self, node, time_elapsed):
         """Adds a new node to the list of all nodes this node has visited"""
-        new_hist = NodeHistory(node.name, node.env.now, time_elapsed, node)
-        self.node_history.append(new_hist)
+        if type(self.node_history) is HistoryStore:
+            self.node_history.append(node.env.now, time_elapsed, node, self.call_infos)
+        else:
+            self.node_history.append(NodeHistory(node.env.now, time_elapsed, node, self.call_infos))
+        
+    def enter_call(self, call_node):
+        """Pushes a sub-activity call onto the call stack"""
+        self.call_infos = self.call_infos + (CallInfo(call_node, call_node.env.now, len(self.fork_infos)),)
+        
+    def exit_call(self):
+        """Pops the innermost sub-activity call, returning it.
+           Forks made inside the call that were never joined are closed, so the token returns as the one that called it"""
+        call_info = self.call_infos[-1]
+        self.call_infos = self.call_infos[:-1]
+        if len(self.fork_infos) > call_info.fork_depth:
+            self.node_history = self.full_history(call_info.fork_depth)
+            self.fork_infos = self.fork_infos[:call_info.fork_depth]
+        return call_info
+        
+def new_history():
+    return HistoryStore() if ExecToken.compact_history else []
+    
         
 class NodeHistory:
-    def __init__(self, name, time_entered, time_elapsed, node):
-        self.name = name
+    __slots__ = ('time_entered', 'time_elapsed', 'node', 'call_infos')
+    def __init__(self, time_entered, time_elapsed, node, call_infos=()):
         self.time_entered = time_entered
         self.time_elapsed = time_elapsed
         self.node = node
+        # The token's call stack; a tuple shared with the token, so it costs nothing to keep
+        self.call_infos = call_infos
+        
+    # Nodes inside sub-activities are shared between every call site,
+    # so they are identified by the path of calls leading to them.
+    # Worked out when asked for, instead of stored with every visit
+    @property
+    def path_id(self):
+        return tuple(c.call_node.id for c in self.call_infos) + (self.node.id,)
+        
+    @property
+    def name(self):
+        if not self.call_infos:
+            return self.node.label
+        return '/'.join([c.call_node.label for c in self.call_infos] + [self.node.label])
+        
+        
+class HistoryStore:
+    """Node history kept as one column per field, instead of one object per visit.
+       Behaves like the list of NodeHistory it replaces (append aside); entries are made when read"""
+    __slots__ = ('times_entered', 'times_elapsed', 'nodes', 'call_infos')
+    def __init__(self):
+        # Columns are made on the first append; every fork child starts with an empty history,
+        # and many never log anything before they join
+        self.times_entered = None
+        self.times_elapsed = None
+        self.nodes = None
+        self.call_infos = None
+        
+    def allocate_columns(self):
+        self.times_entered = array('d')
+        self.times_elapsed = array('d')
+        self.nodes = []
+        self.call_infos = []
+        
+    def append(self, time_entered, time_elapsed, node, call_infos):
+        if self.nodes is None:
+            self.allocate_columns()
+        self.times_entered.append(time_entered)
+        self.times_elapsed.append(time_elapsed)
+        self.nodes.append(node)
+        self.call_infos.append(call_infos)
+        
+    def __len__(self):
+        return 0 if self.nodes is None else len(self.nodes)
+        
+    def __getitem__(self, i):
+        if self.nodes is None:
+            raise IndexError('history index out of range')
+        return NodeHistory(self.times_entered[i], self.times_elapsed[i], self.nodes[i], self.call_infos[i])
+        
+    def __iter__(self):
+        for i in range(len(self)):
+            yield NodeHistory(self.times_entered[i], self.times_elapsed[i], self.nodes[i], self.call_infos[i])
+            
+    def __iadd__(self, other):
+        if other.nodes is None:
+            return self
+        if self.nodes is None:
+            self.allocate_columns()
+        self.times_entered.extend(other.times_entered)
+        self.times_elapsed.extend(other.times_elapsed)
+        self.nodes.extend(other.nodes)
+        self.call_infos.extend(other.call_infos)
+        return self
+        
+    def __add__(self, other):
+        combined = HistoryStore()
+        combined += self
+        combined += other
+        return combined
+        
+        
+class RunInfo:
+    """State shared by all tokens of one run"""
+    __slots__ = ('ended', 'waiting_joins', 'rng')
+    def __init__(self, rng=None):
+        # Set once the run has finished; any of its tokens still going are then dropped
+        self.ended = False
+        # (join node, fork parent id) of every join holding tokens of this run,
+        # so they can be let go of if the run ends before the join completes
+        self.waiting_joins = set()
+        # Where the run's random draws come from. Runs started by the sim get their own generator (see sim.py),
+        # so a run's draws don't depend on which other runs overlap it. Defaults to the global one
+        self.rng = rng if rng is not None else random
         
         
 class ForkInfo:
     """Holds the nessesary info to repair fork exectuion tokens at the corresponding join"""
+    __slots__ = ('parent_id', 'num_children', 'parent_node_history')
     def __init__(self, parent_id, num_children, parent_node_history):
         self.parent_id = parent_id
         self.num_children = num_children
-        self.parent_node_history = parent_node_history
\ No newline at end of file
+        self.parent_node_history = parent_node_history
+        
+        
+class CallInfo:
+    """Holds the call site of a sub-activity, so the token can return there when the sub-activity finishes.
+       Shared by every token inside the same call"""
+    __slots__ = ('call_node', 'enter_time', 'fork_depth', 'ended')
+    def __init__(self, call_node, enter_time, fork_depth=0):
+        self.call_node = call_node
+        self.enter_time = enter_time
+        # How many forks the calling token was inside of
+        self.fork_depth = fork_depth
+        # Set once the first token reaches the sub-activity's final node; any others still inside are dropped
+        self.ended = False
@@ -1,5 +1,6 @@
 import csv
 import pandas as pd
+from sketch import QuantileSketch
 
 class Logger:
     """Central logging system for console printing and/or file logging"""
@@ -9,9 +10,14 @@ class Logger:
     def __init__(self, env, log_mode, results_file, out_file=''):
         self.log_mode = log_mode
         self.env = env
-        self.summary_stats = []
-        self.run_details = {}
+        self.clear_results()
         self.results_file = results_file
+        # Extra sheets for the results file; each is a function returning a list of row dicts
+        self.extra_sheets = {}
+        # Optional binary event trace (see event_trace.py)
+        self.trace = None
+        # Per-event text logging can be turned off when a trace is kept instead
+        self.log_sim_events = True
         if log_mode == Logger.LOG_PRINT:
             self.log = self.log_print
         elif log_mode == Logger.LOG_FILE:
@@ -25,6 +31,17 @@ class Logger:
                 raise Exception("No Log File given.")
             self.out_file = out_file
         
+    def clear_results(self):
+        """Drops every recorded run"""
+        self.summary_stats = []
+        self.run_details = {}
+        # Distributions of run time, and of each node's total time per run.
+        # Percentiles come from these, so need constant memory whatever the number of runs
+        self.run_time_sketch = QuantileSketch()
+        # Keyed by path id, like the per-run rows, since different nodes can share a name
+        self.node_sketches = {}
+        self.node_names = {}
+        
     def log_print(self, msg, log_time=True):
         """log to the console"""
         if log_time:
@@ -47,6 +64,8 @@ class Logger:
     
     def log_sim_event(self, run_id, msg):
         """Adds the run id to a log. This distinguishes runs in the log"""
+        if not self.log_sim_events:
+            return
         self.log(f'Run {run_id}: ' + msg)
         
     # Todo: more stats, full pass/fail support, better ordering (filter non-actions)
@@ -59,47 +78,77 @@ class Logger:
             'start_time': token.creation_time,
             'end_time': end_time,
             'total_time_elapsed': end_time-token.creation_time,
-            'num_nodes_visited': len(token.node_history)
+            'num_nodes_visited': len(token.node_history),
+            'failed': did_fail
         }
-        n_ids = self.get_visited_node_ids(token)
-        this_run_details = []
-        for nid in n_ids:
-            this_run_details.append(self.count_node_statistics(token, nid))
+        this_run_details = self.count_node_statistics(token)
         self.run_details[token.run_id] = this_run_details
         self.summary_stats.append(record_dict)
-    
-    def get_visited_node_ids(self, token):
-        """Returns list of every node visited in this token's history"""
-        ids = []
-        for node in token.node_history:
-            if node.node.id not in ids:
-                ids.append(node.node.id)
-        return ids
+        self.add_to_sketches(record_dict, this_run_details)
         
-    def count_node_statistics(self, token, node_id):
-        """count up the various statistics for a specific node"""
-        count = 0
-        total_time = 0
+    def add_to_sketches(self, record_dict, this_run_details):
+        self.run_time_sketch.add(record_dict['total_time_elapsed'])
+        for n_dict in this_run_details:
+            path_id = tuple(n_dict['path_id'])  # a list once it has been through the result cache's JSON
+            if path_id not in self.node_sketches:
+                self.node_sketches[path_id] = QuantileSketch()
+                self.node_names[path_id] = n_dict['node']
+            self.node_sketches[path_id].add(n_dict['Total Time'])
+            
+    def load_runs(self, summary_stats, run_details):
+        """Adds runs recorded elsewhere (ex: cached or checkpointed runs)"""
+        self.summary_stats += summary_stats
+        self.run_details.update(run_details)
+        for record_dict in summary_stats:
+            self.add_to_sketches(record_dict, run_details[record_dict['run_id']])
+            
+    def percentile_rows(self):
+        """Percentiles of run time, then of each node's time per run"""
+        rows = [{'node': 'Run total time', **self.run_time_sketch.summary()}]
+        for path_id, sketch in self.node_sketches.items():
+            rows.append({'node': self.node_names[path_id], **sketch.summary()})
+        return rows
+    
+    def count_node_statistics(self, token):
+        """count up the various statistics for every node visited in this token's history, in order of first visit.
+           Nodes inside sub-activities are counted seperately for each call site"""
+        n_dicts = {}
         for n in token.node_history:
-            if n.node.id == node_id:
-                n_name = n.name
-                total_time += n.time_elapsed
-                count += 1
-        n_dict = {'node': n_name,
-                  'Total Time': total_time, 
-                  'Times Visited': count}
-        return n_dict
+            path_id = n.path_id
+            if path_id not in n_dicts:
+                n_dicts[path_id] = {'node': n.name,
+                                    'Total Time': 0, 
+                                    'Times Visited': 0,
+                                    'path_id': path_id}
+            n_dict = n_dicts[path_id]
+            n_dict['Total Time'] += n.time_elapsed
+            n_dict['Times Visited'] += 1
+        return list(n_dicts.values())
+        
+    def add_results_sheet(self, sheet_name, get_rows):
+        """Adds an extra sheet to the results file. get_rows is only called once the sim is finished"""
+        self.extra_sheets[sheet_name] = get_rows
         
     def log_final_stats(self):
         """Prints the stored run stats"""
+        if self.trace is not None:
+            self.trace.flush()
         if len(self.summary_stats) == 0:
             return  # this should never happen but it would make the log look weird if it did
         self.log("Recording final run statistics", log_time=False)
+        run_times = self.run_time_sketch.summary()
+        self.log(f"Run time: mean {run_times['mean']:.4g}, p50 {run_times['p50']:.4g}, p95 {run_times['p95']:.4g}, "
+                 f"p99 {run_times['p99']:.4g}, max {run_times['max']:.4g}", log_time=False)
         self.summary_stats.sort(key=lambda x: x['run_id'])
         with pd.ExcelWriter(self.results_file) as writer:
             df = pd.DataFrame(self.summary_stats)
             df.to_excel(writer, sheet_name='Summary', index=False)
+            df = pd.DataFrame(self.percentile_rows())
+            df.to_excel(writer, sheet_name='Percentiles', index=False)
             for run_id in sorted(self.run_details):
-                df = pd.DataFrame(self.run_details[run_id])
+                df = pd.DataFrame(self.run_details[run_id]).drop(columns='path_id')
                 df.to_excel(writer, sheet_name=f'Run {run_id}', index=False)
+            for sheet_name in self.extra_sheets:
+                df = pd.DataFrame(self.extra_sheets[sheet_name]())
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
                 
\ No newline at end of file
@@ -0,0 +1,116 @@
+import argparse
+import contextlib
+import io
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import simpy
+
+import exec_token
+from logger import Logger
+from builder import create_sim_graph
+from sim import loop_create_runs_process
+from xml_loader import load_model_data
+
+# Memory footprint benchmark of the sim's runtime objects.
+# Reports bytes per ExecToken and per node history entry (measured with tracemalloc),
+# then the peak RSS of a long sim, each with the normal and the compact history store.
+# The normal store (a list of NodeHistory) is the layout used before the compact one was added,
+# so its row doubles as the "before" numbers.
+# Run with "python memory_benchmark.py"
+
+MODEL_FILE = 'Simulation_Test.xml'
+ACTIVITY_NAME = 'TestPerformanceActivity'
+
+
+class FakeNode:
+    """Stands in for a node when logging history; only env and the node's own fields are used"""
+    def __init__(self, env):
+        self.env = env
+        self.name = 'node'
+        self.label = 'node'
+        self.id = 'node_id'
+
+
+def bytes_per_token(count):
+    # A run's tokens share one RunInfo, so it isn't counted per token
+    run_info = exec_token.RunInfo()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tokens = [exec_token.ExecToken(creation_time=0.0, run_id=i, run_info=run_info) for i in range(count)]
+    used = tracemalloc.get_traced_memory()[0]-before
+    tracemalloc.stop()
+    # Don't count the list holding them
+    return used/count - 8
+
+
+def bytes_per_history_entry(count):
+    node = FakeNode(simpy.Environment())
+    token = exec_token.ExecToken(creation_time=0.0, run_id=0)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        # Distinct elapsed times, like real visits
+        token.log_node_history(node, i*0.5)
+    used = tracemalloc.get_traced_memory()[0]-before
+    tracemalloc.stop()
+    return used/count
+
+
+def rss_mb():
+    """Current and peak RSS of this process in MB.
+       Read from /proc where there is one: ru_maxrss can carry over the parent's peak through exec"""
+    try:
+        with open('/proc/self/status') as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0])/1024, int(fields['VmHWM'].split()[0])/1024
+    except OSError:
+        # ru_maxrss is in KB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        return peak, peak
+
+
+def long_run(num_runs, time_between_runs):
+    """Runs the example model, returning RSS in MB before the sim, peak RSS in MB, and the time taken"""
+    env = simpy.Environment()
+    logger = Logger(env, Logger.LOG_FILE, '', out_file=os.devnull)
+    logger.log_sim_events = False
+    with contextlib.redirect_stdout(io.StringIO()):
+        node_info_dict, edge_info_list, actor_infos, sub_activity_infos = load_model_data(MODEL_FILE, ACTIVITY_NAME)
+        node_dict, edge_list, start_node, actor_dict = create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos, sub_activity_infos)
+    start_rss = rss_mb()[0]
+    start = time.time()
+    env.process(loop_create_runs_process(env, logger, start_node, num_runs, time_between_runs))
+    env.run()
+    return start_rss, rss_mb()[1], time.time()-start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures memory used by tokens and node history')
+    parser.add_argument('--runs', type=int, default=20000, help='runs in the long sim (default 20000)')
+    parser.add_argument('--time-between-runs', type=float, default=0.05, help='small values keep many runs in progress at once (default 0.05)')
+    parser.add_argument('--long-run-only', choices=['normal', 'compact'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.long_run_only is not None:
+        # Child process for one long run, so each gets a clean peak RSS
+        exec_token.ExecToken.compact_history = args.long_run_only == 'compact'
+        start_rss, peak_rss, seconds = long_run(args.runs, args.time_between_runs)
+        print(f'{start_rss} {peak_rss} {seconds}')
+        return
+    print(f'{"history store":>14} {"bytes/token":>12} {"bytes/entry":>12} {"RSS before sim (MB)":>20} {"peak RSS (MB)":>14} {"sim time (s)":>13}')
+    for mode in ['normal', 'compact']:
+        exec_token.ExecToken.compact_history = mode == 'compact'
+        token_bytes = bytes_per_token(100000)
+        entry_bytes = bytes_per_history_entry(200000)
+        out = subprocess.run([sys.executable, __file__, '--long-run-only', mode, '--runs', str(args.runs),
+                              '--time-between-runs', str(args.time_between_runs)], capture_output=True, text=True, check=True)
+        start_rss, peak_rss, seconds = [float(x) for x in out.stdout.split()]
+        print(f'{mode:>14} {token_bytes:>12.0f} {entry_bytes:>12.0f} {start_rss:>20.1f} {peak_rss:>14.1f} {seconds:>13.1f}')
+    print(f'(long sim: {args.runs} runs of {MODEL_FILE}, {args.time_between_runs} time between runs)')
+
+
+if __name__ == "__main__":
+    main()
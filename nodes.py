@@ -1,6 +1,5 @@
 import exec_token
 from invalid_model_error import InvalidModelError
-import random
 
 
 class Node(object):
@@ -9,9 +8,14 @@ class Node(object):
         self.env = env
         self.logger = logger
         self.name = name
+        # Name shown in results. Call sites sharing a name are told apart by the builder (see builder.label_call_sites)
+        self.label = name
         self.id = id
         self.out_edges = []
         self.is_action = False
+        self.sensitivity_analyzer = None
+        # Set on actions, which draw their failures from it (see rare_event.py). Told about runs that end failed
+        self.importance_sampler = None
         
     def add_connection(self, new_edge):
         """Adds a new outgoing edge. This is done post-construction to 
@@ -22,7 +26,7 @@ class Node(object):
     
     def run(self, token):
         """Handles logic of the exection of a Node"""
-        token.log_node_history(self, 0)
+        self.log_visit(token, 0)
         # This is a hacky solution that forces this to be a generator function:
         # TODO: Find a way to declare a generator without any yields
         yield self.env.timeout(0)        
@@ -37,9 +41,33 @@ class Node(object):
         for edge in self.out_edges:
             edge.call_next_node(token)
     
+    def log_visit(self, token, time_elapsed, failed=False):
+        """Adds this node to the token's history, and to the event trace if there is one"""
+        token.log_node_history(self, time_elapsed)
+        if self.logger.trace is not None:
+            self.logger.trace.record_visit(token, token.node_history[-1], failed)
+    
     def finish_run(self, token, fail):
+        """Ends the token's run. A run only ends once: the first of its tokens to finish (or fail) ends it,
+           and its other tokens are dropped"""
+        if token.run_info.ended:
+            self.logger.log_sim_event(token.run_id, f"Token {token.id} finished after the run had ended; dropped")
+            return
+        token.run_info.ended = True
+        for join_node, parent_id in token.run_info.waiting_joins:
+            join_node.waiting_tokens.pop(parent_id, None)
+        token.run_info.waiting_joins.clear()
+        if token.fork_infos:
+            # Ended inside a fork (ex: an action failed in one branch); keep the history from before the fork
+            token.node_history = token.full_history()
         self.logger.log_sim_event(token.run_id, f"Execution completed with token {token.id}")
         self.logger.record_final_stats(token, self.env.now, fail)
+        if self.logger.trace is not None:
+            self.logger.trace.record_run_end(token, self, self.env.now, fail)
+        if self.sensitivity_analyzer is not None:
+            self.sensitivity_analyzer.record_run(token, self.env.now)
+        if fail and self.importance_sampler is not None:
+            self.importance_sampler.record_failed_run(token.run_id)
         
     def __str__(self):
         return f'Node(name={self.name}, id={self.id})'
@@ -48,6 +76,9 @@ class Node(object):
 class TimeAndFailNode(Node):
     """Specific kind of node that has takes an amount of time to finish,
        and has a chance of failing. Both are displayed in output"""
+    def __init__(self, env, logger, name, id):
+        super().__init__(env, logger, name, id)
+        self.fail_edge = None
     
     def run(self, token):
         """Overrided version that also handles fails and timeouts"""
@@ -55,15 +86,26 @@ class TimeAndFailNode(Node):
         yield self.env.timeout(0)
         self.logger.log_sim_event(token.run_id, f"Activating Node {self.name}")
         # Calculate action time, action success
-        succeeds = self.calc_success()
-        action_time = self.calc_time()
+        succeeds = self.calc_success(token)
+        if self.sensitivity_analyzer is not None:
+            action_time = self.sensitivity_analyzer.sample_time(self, token)
+        else:
+            action_time = self.calc_time(token.run_info.rng)
         yield self.env.timeout(action_time)
+        if token.is_dropped():
+            # Another branch ended the run (or the sub-activity call) while this action was going
+            self.logger.log_sim_event(token.run_id, f'Action {self.name} finishes after its run or call ended; token {token.id} dropped')
+            return
+        self.log_visit(token, self.env.now-node_enter_time, failed=not succeeds)
         if succeeds:
             self.logger.log_sim_event(token.run_id, f'Action {self.name} finishes')
+            self.call_edges(token)
         else:
             self.logger.log_sim_event(token.run_id, f'Action {self.name} finishes; FAIL')
-        token.log_node_history(self, self.env.now-node_enter_time)
-        self.call_edges(token)
+            if self.fail_edge is not None:
+                self.fail_edge.call_next_node(token)
+            else:
+                self.finish_run(token, fail=True)
     
     def add_fail_edge(self, fail_edge):
         """Gives a SINGLE edge that will be traveled if the action fails.
@@ -72,15 +114,24 @@ class TimeAndFailNode(Node):
             raise InvalidModelError(f"Node {self.name} has more than one registered failure edge.")
         self.fail_edge = fail_edge
         
-    def calc_success(self):
+    def calc_success(self, token):
         """Uses env and performance varables to see if action succeeds or not"""
         return True # Base nodes always succeed
     
-    def calc_time(self):
-        """Calculate action time using performance and other variables"""
+    def calc_time(self, rng):
+        """Calculate action time using performance and other variables, drawing from rng (a random.Random)"""
         # TODO: maybe make this a constant (defined at runtime)
         return 1 # units undefined like IMPRINT
         
+    def calc_time_and_derivatives(self, rng):
+        """Calculate action time, along with its derivative with respect to each timing parameter.
+           Used in sensitivity mode; nodes without parameters have no derivatives"""
+        return self.calc_time(rng), {}
+        
+    def get_timing_params(self):
+        """The current value of each timing parameter, by name"""
+        return {}
+        
     
 class InitialNode(Node):
     def __init__(self, env, logger, name, id):
@@ -110,7 +161,8 @@ class ForkNode(Node):
 class JoinNode(Node):
     def __init__(self, env, logger, name, id):
         super().__init__(env, logger, name, id)
-        self.waiting_tokens = []
+        # Tokens waiting for their siblings, by the id of the token that forked them
+        self.waiting_tokens = {}
     
     def all_incoming_edges_ready(self):
         for edge in incoming_edges:
@@ -127,27 +179,32 @@ class JoinNode(Node):
     def call_edges(self, token):
         if token.fork_infos == []:
             raise InvalidModelError("Join node with no previous fork")
+        if token.is_dropped():
+            # Don't hold on to tokens of a run (or sub-activity call) that has already ended
+            self.logger.log_sim_event(token.run_id, f'JoinNode {self.name} dropped ExecToken {token.id}; its run or call has ended.')
+            return
         fork_info = token.fork_infos[-1]
-        matches = []
-        for other in self.waiting_tokens:
-            if fork_info.parent_id == other.fork_infos[-1].parent_id:
-                matches.append(other)
+        matches = self.waiting_tokens.get(fork_info.parent_id, [])
         # Go foward with the join nodes
         required_matches = fork_info.num_children-1
         if len(matches) == required_matches:
             # -1 to not count join for every path, but +1 because we need to count it once
             combined_history = fork_info.parent_node_history + token.node_history
+            self.waiting_tokens.pop(fork_info.parent_id, None)
+            token.run_info.waiting_joins.discard((self, fork_info.parent_id))
             for m in matches:
-                self.waiting_tokens.remove(m)
                 combined_history += m.node_history  # subtract one so we dont count this join for every incoming
             token.fork_infos.pop()
-            new_token = exec_token.ExecToken(token.creation_time, token.run_id, token.fork_infos, combined_history)
-            new_token.log_node_history(self, 0)
+            # This token arrived last, so its path is the critical one, and the one its derivatives follow
+            new_token = exec_token.ExecToken(token.creation_time, token.run_id, token.fork_infos, combined_history, token.call_infos, token.time_grads,
+                                             token.run_info)
+            self.log_visit(new_token, 0)
             self.logger.log_sim_event(token.run_id, f"JoinNode {self.name} Recieved ExecToken {token.id}; all incoming edges ready.")
             super().call_edges(new_token)
         # First node in pair; wait for 2nd
         elif len(matches) < required_matches:
-            self.waiting_tokens.append(token)
+            self.waiting_tokens.setdefault(fork_info.parent_id, []).append(token)
+            token.run_info.waiting_joins.add((self, fork_info.parent_id))
             self.logger.log_sim_event(token.run_id, f'JoinNode {self.name} Recieved ExecToken {token.id}; not enough matching pairs yet.')
         else:  # somehow we overshot
             raise Exception("Somehow exceeded the number of incoming joins")
@@ -158,9 +215,18 @@ class FinalNode(Node):
         super().__init__(env, logger, name, id)
         
     def run(self, token):
-        token.log_node_history(self, 0)
+        self.log_visit(token, 0)
         yield self.env.timeout(0)
-        self.finish_run(token, fail=False)
+        if token.call_infos:
+            # Final node of a sub-activity. Like a run, the call ends once: the first token back returns to the caller
+            if token.call_infos[-1].ended:
+                self.logger.log_sim_event(token.run_id, f"Token {token.id} reached {self.name} after its sub-activity had ended; dropped")
+                return
+            token.call_infos[-1].ended = True
+            call_info = token.exit_call()
+            call_info.call_node.return_from_call(token, call_info)
+        else:
+            self.finish_run(token, fail=False)
         # TODO: Log to env? need x amount to complete?
     # TODO: some override for run() that does cleanup?
     
@@ -169,24 +235,26 @@ class DecisionNode(Node):
         super().__init__(env, logger, name, id)
         
     # Returns edge to be followed
-    def choose_path(self):
+    def choose_path(self, rng):
         weights = [e.probability for e in self.out_edges]
         # Check for None values.
         sum_nones = weights.count(None)
         if sum_nones == len(self.out_edges):
             # If all none, then choose with no weighting
-            return random.choice(self.out_edges)
+            return rng.choice(self.out_edges)
         elif sum_nones > 0:
             # If some but not all None, error
             raise InvalidModelError("Must have all probabilites defined, or none")
         else:
             # If none None, chose based on probability
-            return random.choices(self.out_edges, weights=weights, k=1)[0]
+            return rng.choices(self.out_edges, weights=weights, k=1)[0]
             
     def call_edges(self, token):
         if self.out_edges is None:
             raise Exception(f"Node {self.name} attemped to call edges with no outgoing edges present.")
-        edge_to_follow = self.choose_path()
+        edge_to_follow = self.choose_path(token.run_info.rng)
+        if self.sensitivity_analyzer is not None:
+            self.sensitivity_analyzer.record_choice(self, token, edge_to_follow)
         self.logger.log_sim_event(token.run_id, f'DecisionNode {self.name} chose path: edge {edge_to_follow.name}')
         edge_to_follow.call_next_node(token)
         
@@ -199,22 +267,60 @@ class PerformanceActivity(TimeAndFailNode):
         self.actor = actor
         self.performance_info = performance_info
         self.is_action = True
+        self.fail_chance = 0
+        self.psf_table = None
+        self.psf_key = None
+        
+    def set_psf_table(self, psf_table):
+        """Enables PSF adjustment of this action, precomputing its multipliers in the table"""
+        if self.actor is None:
+            raise InvalidModelError(f"Action {self.name} has PSFs enabled, but no actor to take enviroment values from.")
+        self.psf_table = psf_table
+        self.psf_key = psf_table.taxon_key(self.performance_info)
+        psf_table.lookup(self.actor, self.psf_key)
+        
     def add_connection(self, new_edge):
         super().add_connection(new_edge)
         if len(self.out_edges) > 1:
             raise InvalidModelError("Actions can only have one outgoing edge")
             # TODO: is this true?
         
+    def calc_fail_chance(self):
+        """Chance of this action failing, after PSF adjustment"""
+        if self.psf_table is None or self.fail_chance == 0:
+            return self.fail_chance
+        return min(1, self.fail_chance * self.psf_table.lookup(self.actor, self.psf_key)[1])
+        
     # Uses env and performance varables to see if action succeeds or not
-    def calc_success(self):
-        return True # TODO
-        # This uses actor + performance stuff
+    def calc_success(self, token):
+        fail_chance = self.calc_fail_chance()
+        if self.importance_sampler is not None:
+            # Rare event mode: the sampler draws from a tilted chance and tracks the run's weight
+            return self.importance_sampler.sample_success(self, token, fail_chance)
+        if fail_chance == 0:
+            return True
+        return token.run_info.rng.random() >= fail_chance
         
     # Calculate action time using performance and other variables
-    def calc_time(self):
+    def calc_time(self, rng):
+        if self.psf_table is None:
+            return self.calc_base_time(rng)
+        return self.calc_base_time(rng) * self.psf_table.lookup(self.actor, self.psf_key)[0]
+        
+    def calc_time_and_derivatives(self, rng):
+        base_time, derivatives = self.calc_base_time_and_derivatives(rng)
+        if self.psf_table is None:
+            return base_time, derivatives
+        time_mult = self.psf_table.lookup(self.actor, self.psf_key)[0]
+        return base_time*time_mult, {p: d*time_mult for p, d in derivatives.items()}
+        
+    def calc_base_time(self, rng):
+        """Action time before any PSF adjustment. Overrided by the timing types"""
         return PerformanceActivity.BASE_TTC # units undefined like IMPRINT
-        # TODO
-        # This uses actor + performance stuff
+        
+    def calc_base_time_and_derivatives(self, rng):
+        """Same as calc_base_time, also giving derivatives. Overrided by the timing types"""
+        return self.calc_base_time(rng), {}
 
 
 class UniformTimeNode(PerformanceActivity):
@@ -226,8 +332,17 @@ class UniformTimeNode(PerformanceActivity):
         self.time_min = time_min
         self.time_max = time_max
 
-    def calc_time(self):
-        return random.randint(self.time_min, self.time_max)
+    def calc_base_time(self, rng):
+        return rng.randint(self.time_min, self.time_max)
+        
+    def calc_base_time_and_derivatives(self, rng):
+        # Treated as continuous: time = min + u*(max-min), using the midpoint of the drawn integer's bin for u
+        time = self.calc_base_time(rng)
+        u = (time-self.time_min+0.5)/(self.time_max-self.time_min+1)
+        return time, {'Min': 1-u, 'Max': u}
+        
+    def get_timing_params(self):
+        return {'Min': self.time_min, 'Max': self.time_max}
 
 
 class StaticTimeNode(PerformanceActivity):
@@ -236,9 +351,15 @@ class StaticTimeNode(PerformanceActivity):
         super().__init__(env, logger, name, id, performance_info, actor)
         self.time_static = time_static
     
-    def calc_time(self):
+    def calc_base_time(self, rng):
         return self.time_static
         
+    def calc_base_time_and_derivatives(self, rng):
+        return self.time_static, {'Time': 1}
+        
+    def get_timing_params(self):
+        return {'Time': self.time_static}
+        
 class NormalTimeNode(PerformanceActivity):
     """Action That uses a normal distribusion for timing"""
     def __init__(self, env, logger, name, id, performance_info, actor, time_mean, time_stdev):
@@ -246,8 +367,43 @@ class NormalTimeNode(PerformanceActivity):
         self.time_mean = time_mean
         self.time_stdev = time_stdev
         
-    def calc_time(self):
-        return max(0, round(random.normalvariate(self.time_mean, self.time_stdev)))
+    def calc_base_time(self, rng):
+        return max(0, round(rng.normalvariate(self.time_mean, self.time_stdev)))
+        
+    def calc_base_time_and_derivatives(self, rng):
+        # Draws the same way as calc_base_time, but keeps the unrounded value: time = mean + stdev*z
+        raw_time = rng.normalvariate(self.time_mean, self.time_stdev)
+        if raw_time <= 0:
+            # Clamped at 0, so small parameter changes have no effect
+            return 0, {'Mean': 0, 'Standard_Deviation': 0}
+        z = (raw_time-self.time_mean)/self.time_stdev if self.time_stdev != 0 else 0
+        return round(raw_time), {'Mean': 1, 'Standard_Deviation': z}
+        
+    def get_timing_params(self):
+        return {'Mean': self.time_mean, 'Standard_Deviation': self.time_stdev}
+        
+        
+# Sub-activity graphs are built once per activity and shared by every action calling them.
+# All per-call state lives on the token's call stack, so the shared nodes never need to know who called them
+class CallActivityNode(Node):
+    """Action that runs the graph of another activity, continuing once that activity reaches its final node"""
+    def __init__(self, env, logger, name, id, template, actor=None):
+        super().__init__(env, logger, name, id)
+        self.template = template
+        self.actor = actor
+        self.is_action = True
+        
+    def run(self, token):
+        yield self.env.timeout(0)
+        self.logger.log_sim_event(token.run_id, f"Activating {type(self).__name__} {self.name}; calling sub-activity {self.template.name}")
+        token.enter_call(self)
+        self.env.process(self.template.start_node.run(token))
+        
+    def return_from_call(self, token, call_info):
+        """Called by the sub-activity's final node. The time spent in the sub-activity is logged against this node"""
+        self.logger.log_sim_event(token.run_id, f"Sub-activity {self.template.name} finished; returning to {self.name}")
+        self.log_visit(token, self.env.now-call_info.enter_time)
+        self.call_edges(token)
         
         
 # Sinals are managed by imagining the acceptors are physcially linked to the senders
@@ -0,0 +1,158 @@
+import json
+from xml_loader import ENVIROMENT_ATTRIBS, PERF_ATTRIBS
+
+# Performance Shaping Factors (PSFs), in the style of IMPRINT's stressor adjustments.
+# An action's time and failure chance are scaled by multipliers that depend on its actor's
+# enviroment and on the action's taxon mix. These only change when the enviroment does,
+# so they are computed once and cached instead of recalculated on every action execution.
+# Without coefficients (the default), every multiplier is 1. Choose them with a "psf" section
+# in config.json: {"coefficients": "path/to/table.json"} for a calibrated table in the same
+# shape as STRESSOR_SENSITIVITY, or {"coefficients": "placeholder"} for the built-in table.
+
+# Levels of each enviroment stressor, from least to most severe, as defined in the SimProfile.
+# 'N/A' (or any unknown value) has no effect
+STRESSOR_LEVELS = {
+    'Cold_Temperature': ['33F to 50F', '15F to 32F', '-3F to 14F', '-21F to -4F', '-40F to -22F', 'Less than -40F'],
+    'Wind': ['0 to 10', '11 to 20', '21 to 30', '31 to 40', '41 to 50', 'Greater than 50'],
+    'Heat_Temperature': ['77F to 84F', '85F to 93F', '94F to 102F', '103F to 111F', 'Greater than 111F'],
+    'Humidity': ['0% to 10%', '11% to 20%', '21% to 30%', '31% to 40%', '41% to 50%', '51% to 60%',
+                 '61% to 70%', '71% to 80%', '81% to 90%', '91% to 100%'],
+    'Noise_Decibels': ['50 to 60', '60 to 70', '70 to 80', '80 to 90', '90 to 100', '100 to 110', 'Greater than 110'],
+    # Further away is less severe
+    'Noise_Distance': ['Greater than 20', '16 to 20', '11 to 15', '10', '9', '8', '7', '6', '5', '4', '3', '2', '1'],
+    'Whole_Body_Vibration_Frequency': ['Low', 'Medium', 'High'],
+    'Whole_Body_Vibration_Magnitude': ['Low', 'Medium', 'High'],
+    'Sleepess_Hours': ['0 to 24', '25 to 47', '48 to 71', '72 to 95', 'Greater than 95'],
+    'MOPP_Gear': ['Level 0', 'Level 1', 'Level 2', 'Level 3', 'Level 4'],
+    'Level_A_Gear': ['Gear Off', 'Gear On'],
+    'Weight_Load': ['20 kg', '25 kg', '30 kg', '35 kg'],
+}
+
+# Taxons grouped by the kind of work they represent
+TAXON_GROUPS = {
+    'cognitive': ['Visual_Recognition_Taxon', 'Information_Taxon', 'Oral_Taxon',
+                  'Reading_and_Writing_Taxon', 'Numerical_Analysis_Taxon'],
+    'fine_motor': ['Fine_Motor_Discrete_Taxon', 'Fine_Motor_Continuous_Taxon'],
+    'gross_motor': ['Gross_Motor_Light_Taxon', 'Gross_Motor_Heavy_Taxon'],
+}
+
+# (time increase, failure increase) of each taxon group at a stressor's most severe level.
+# These are placeholder values in the shape of IMPRINT's tables; calibrate before relying on them.
+# They are only used when asked for by name
+STRESSOR_SENSITIVITY = {
+    'Cold_Temperature': {'cognitive': (0.10, 0.10), 'fine_motor': (0.50, 0.60), 'gross_motor': (0.20, 0.15)},
+    'Wind': {'cognitive': (0.05, 0.05), 'fine_motor': (0.20, 0.25), 'gross_motor': (0.15, 0.10)},
+    'Heat_Temperature': {'cognitive': (0.25, 0.30), 'fine_motor': (0.15, 0.20), 'gross_motor': (0.40, 0.30)},
+    'Humidity': {'cognitive': (0.05, 0.05), 'fine_motor': (0.05, 0.05), 'gross_motor': (0.15, 0.10)},
+    'Noise_Decibels': {'cognitive': (0.20, 0.30), 'fine_motor': (0.05, 0.05), 'gross_motor': (0.0, 0.0)},
+    'Noise_Distance': {'cognitive': (0.10, 0.15), 'fine_motor': (0.0, 0.0), 'gross_motor': (0.0, 0.0)},
+    'Whole_Body_Vibration_Frequency': {'cognitive': (0.10, 0.15), 'fine_motor': (0.40, 0.50), 'gross_motor': (0.05, 0.05)},
+    'Whole_Body_Vibration_Magnitude': {'cognitive': (0.10, 0.15), 'fine_motor': (0.40, 0.50), 'gross_motor': (0.05, 0.05)},
+    'Sleepess_Hours': {'cognitive': (0.60, 0.80), 'fine_motor': (0.30, 0.40), 'gross_motor': (0.20, 0.20)},
+    'MOPP_Gear': {'cognitive': (0.15, 0.20), 'fine_motor': (0.60, 0.50), 'gross_motor': (0.50, 0.30)},
+    'Level_A_Gear': {'cognitive': (0.20, 0.25), 'fine_motor': (0.80, 0.60), 'gross_motor': (0.60, 0.40)},
+    'Weight_Load': {'cognitive': (0.0, 0.0), 'fine_motor': (0.05, 0.05), 'gross_motor': (0.50, 0.30)},
+}
+
+
+def stressor_severity(stressor, value):
+    """Returns how severe a stressor level is, from 0 (no effect) to 1 (most severe level)"""
+    levels = STRESSOR_LEVELS.get(stressor, [])
+    if value not in levels or len(levels) < 2:
+        return 0
+    return levels.index(value) / (len(levels)-1)
+
+
+def taxon_group_weights(taxons):
+    """Turns the taxon percentages of an action into the fraction of work done in each group.
+       Actions with no taxons set have no group, and so are unaffected by stressors"""
+    total = sum(taxons.values())
+    if total == 0:
+        return {}
+    return {g: sum(taxons.get(t, 0) for t in TAXON_GROUPS[g])/total for g in TAXON_GROUPS}
+
+
+def stressor_modifier(perf_env, taxons, coefficients):
+    """Each stressor adds time/failure in proportion to its severity and the action's
+       share of work in each taxon group. Stressors compound"""
+    weights = taxon_group_weights(taxons)
+    time_mult = 1
+    fail_mult = 1
+    for stressor in ENVIROMENT_ATTRIBS:
+        severity = stressor_severity(stressor, perf_env.get(stressor, 'N/A'))
+        if severity == 0:
+            continue
+        sensitivity = coefficients.get(stressor, {})
+        time_mult *= 1 + severity*sum(weights[g]*sensitivity.get(g, (0, 0))[0] for g in weights)
+        fail_mult *= 1 + severity*sum(weights[g]*sensitivity.get(g, (0, 0))[1] for g in weights)
+    return time_mult, fail_mult
+
+
+def load_coefficients(psf_options):
+    """The stressor coefficients chosen by the config's "psf" section, or None if none were chosen"""
+    if psf_options is None or psf_options.get('coefficients') is None:
+        return None
+    source = psf_options['coefficients']
+    if source == 'placeholder':
+        return STRESSOR_SENSITIVITY
+    with open(source) as f:
+        coefficients = json.load(f)
+    for stressor, groups in coefficients.items():
+        if stressor not in STRESSOR_LEVELS:
+            raise Exception(f'Unknown stressor {stressor} in PSF coefficients {source}')
+        for group, pair in groups.items():
+            if group not in TAXON_GROUPS or len(pair) != 2:
+                raise Exception(f'PSF coefficients {source}: {stressor} needs a [time, failure] pair for each of {list(TAXON_GROUPS)}')
+    return coefficients
+
+
+def create_psf_table(coefficients):
+    """A PSFTable using the given stressor coefficients. With none, every multiplier is 1"""
+    if coefficients is None:
+        return PSFTable()
+    return PSFTable([lambda perf_env, taxons: stressor_modifier(perf_env, taxons, coefficients)])
+
+
+class PSFTable:
+    """Cache of (time, failure) multipliers, keyed by actor and taxon vector.
+       Modifiers are functions of (perf_env, taxons) returning a (time_mult, fail_mult) pair;
+       the results of every modifier are multiplied together. With no modifiers, nothing is adjusted"""
+    def __init__(self, modifiers=None):
+        if modifiers is None:
+            modifiers = []
+        self.modifiers = modifiers
+        self.table = {}
+
+    @staticmethod
+    def taxon_key(performance_info):
+        """The hashable form of an action's taxons, in PERF_ATTRIBS order"""
+        return tuple(performance_info.get(t, 0) for t in PERF_ATTRIBS)
+
+    def compute(self, actor, taxon_key):
+        """Evaluates every modifier. This is the expensive part, so it should only be done on a cache miss"""
+        taxons = dict(zip(PERF_ATTRIBS, taxon_key))
+        time_mult = 1
+        fail_mult = 1
+        for modifier in self.modifiers:
+            t, f = modifier(actor.perv_env, taxons)
+            time_mult *= t
+            fail_mult *= f
+        return time_mult, fail_mult
+
+    def lookup(self, actor, taxon_key):
+        """Returns the (time_mult, fail_mult) pair, computing it only if not already cached"""
+        key = (actor.id, taxon_key)
+        try:
+            return self.table[key]
+        except KeyError:
+            actor.register_psf_table(self)
+            self.table[key] = self.compute(actor, taxon_key)
+            return self.table[key]
+
+    def invalidate(self, actor=None):
+        """Drops cached entries for one actor (or all actors if none given).
+           Called by the actor when its enviroment changes"""
+        if actor is None:
+            self.table = {}
+        else:
+            self.table = {k: v for k, v in self.table.items() if k[0] != actor.id}
@@ -0,0 +1,84 @@
+import math
+
+# Importance sampling for rare action failures.
+# Failure chances of 1e-4 to 1e-6 would need millions of plain runs to see any failures at all.
+# Instead, each action's failure chance is tilted up (p -> q) so failures happen often, and each
+# run is weighted by its likelihood ratio: the product of p/q for every failure drawn and
+# (1-p)/(1-q) for every success. The mean of (run failed * weight) is then an unbiased
+# estimate of the true chance of a run failing.
+
+
+class ImportanceSampler:
+    """Draws tilted action failures and tracks the likelihood ratio of every run.
+       failure_tilt multiplies every action's fail chance, capped at max_fail_chance.
+       node_fail_chances optionally gives a fixed tilted chance per node name instead"""
+    def __init__(self, failure_tilt=100, max_fail_chance=0.5, node_fail_chances=None):
+        if failure_tilt < 1:
+            raise Exception("failure_tilt must be at least 1; tilting failures down is never useful here")
+        if not 0 < max_fail_chance < 1:
+            raise Exception("max_fail_chance must be between 0 and 1")
+        self.failure_tilt = failure_tilt
+        self.max_fail_chance = max_fail_chance
+        self.node_fail_chances = node_fail_chances if node_fail_chances is not None else {}
+        # Both keyed by run id. Weights are kept as logs, since they are products of many factors
+        self.log_weights = {}
+        self.failed_runs = set()
+
+    def tilted_chance(self, node, fail_chance):
+        """The chance the failure is actually drawn with"""
+        if fail_chance == 0:
+            return 0
+        try:
+            return self.node_fail_chances[node.name]
+        except KeyError:
+            return max(fail_chance, min(self.max_fail_chance, fail_chance*self.failure_tilt))
+
+    def sample_success(self, node, token, fail_chance):
+        """Draws whether the node succeeds using the tilted chance, and updates the run's weight"""
+        tilted = self.tilted_chance(node, fail_chance)
+        if tilted == 0:
+            return True
+        failed = token.run_info.rng.random() < tilted
+        if failed:
+            ratio = fail_chance/tilted
+        else:
+            ratio = (1-fail_chance)/(1-tilted)
+        log_ratio = math.log(ratio) if ratio > 0 else -math.inf
+        self.log_weights[token.run_id] = self.log_weights.get(token.run_id, 0) + log_ratio
+        return not failed
+
+    def record_failed_run(self, run_id):
+        """Called when a run actually ends failed. A drawn failure alone isn't enough:
+           another branch may end the run first, or the failure may be handled by a fail edge"""
+        self.failed_runs.add(run_id)
+
+    def run_weight(self, run_id):
+        """Likelihood ratio of a run. Runs that never drew a failure chance have a weight of 1"""
+        return math.exp(self.log_weights.get(run_id, 0))
+
+    def estimate(self, num_runs, z=1.96):
+        """Estimates the chance of a run ending failed.
+           Every run started must be counted, including ones that never reached an action"""
+        if num_runs < 2:
+            raise Exception("At least 2 runs are needed to estimate a confidence interval")
+        values = [self.run_weight(r) for r in self.failed_runs]
+        mean = sum(values)/num_runs
+        # Runs that did not fail contribute zeros
+        sq_dev = sum((v-mean)**2 for v in values) + (num_runs-len(values))*mean**2
+        std_error = math.sqrt(sq_dev/(num_runs-1)/num_runs)
+        return {'failure_probability': mean,
+                'std_error': std_error,
+                'ci_low': max(0, mean-z*std_error),
+                'ci_high': mean+z*std_error,
+                'relative_error': std_error/mean if mean > 0 else math.inf,
+                'num_runs': num_runs,
+                'num_failed_runs': len(values)}
+
+    def log_estimate(self, logger, num_runs):
+        """Logs the failure estimate"""
+        est = self.estimate(num_runs)
+        logger.log("Rare event (importance sampling) failure estimate:", log_time=False)
+        logger.log(f"    P(run fails) = {est['failure_probability']:.4g} "
+                   f"(95% CI {est['ci_low']:.4g} to {est['ci_high']:.4g}, relative error {est['relative_error']:.3g})", log_time=False)
+        logger.log(f"    {est['num_failed_runs']} of {est['num_runs']} runs failed under the tilted chances", log_time=False)
+        return est
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+
+# Local disk cache of simulation results, keyed by a hash of everything that determines them:
+# the loaded model data, the effective config and the seed.
+# Each entry is one JSON file holding the summary and per-node results of every cached run,
+# along with a checksum so damaged files are dropped instead of used.
+
+# Bump this whenever a change to the sim would change results for the same model/config/seed
+CACHE_VERSION = 4
+
+
+class ResultCache:
+    """Stores results by key, evicting least recently used entries once over max_bytes"""
+    def __init__(self, cache_dir, max_bytes=500*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """Hashes any JSON-like data (ex: the loaded model data, config values and seed) into a key"""
+        data = json.dumps([CACHE_VERSION, parts], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def checksum(entry):
+        data = json.dumps([entry['num_runs'], entry['summary_stats'], entry['run_details']], sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def load(self, key):
+        """Returns (num_runs, summary_stats, run_details) for the key, or None if not cached (or damaged)"""
+        path = self.entry_path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if entry['key'] != key or entry['checksum'] != self.checksum(entry):
+                raise ValueError('checksum mismatch')
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError):
+            print(f'Cache entry {key} is damaged; discarding it')
+            os.remove(path)
+            return None
+        # Mark as recently used
+        os.utime(path)
+        # JSON keys are always strings; run ids are ints
+        run_details = {int(r): entry['run_details'][r] for r in entry['run_details']}
+        return entry['num_runs'], entry['summary_stats'], run_details
+
+    def store(self, key, num_runs, summary_stats, run_details):
+        """Saves results for the key, replacing any older entry, then evicts if over the size limit"""
+        entry = {'key': key,
+                 'num_runs': num_runs,
+                 'summary_stats': summary_stats,
+                 'run_details': {str(r): run_details[r] for r in run_details}}
+        entry['checksum'] = self.checksum(entry)
+        path = self.entry_path(key)
+        # Write then rename, so a crash never leaves a half written entry in place
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Deletes least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
@@ -0,0 +1,101 @@
+import math
+
+# Single-pass sensitivity analysis of run completion time.
+# Instead of rerunning the whole experiment once per perturbed parameter, derivatives of
+# completion time are estimated within the same runs as the baseline:
+#   Timing parameters use infinitesimal perturbation analysis (IPA). Each token carries the
+#   derivative of its elapsed time with respect to every parameter on its path. At a join the
+#   last token to arrive decides when the join continues, so its derivatives are the ones kept.
+#   Decision edge probabilities are discrete choices, so they use a likelihood ratio (score
+#   function) estimator instead: d E[T]/d w = Cov(T, d log P(choices)/d w).
+# Times are treated as continuous, so the rounding done by the timing types is ignored.
+
+
+class SensitivityAnalyzer:
+    """Collects derivatives of completion time during the sim, and turns them into a ranked table"""
+    def __init__(self):
+        self.nodes = {}  # node id -> node with timing parameters
+        self.edges = {}  # edge id -> (decision node, edge)
+        # Keyed by run id. runs holds (end time, completion time, time derivatives) of the token that ended the run
+        self.runs = {}
+        self.run_scores = {}
+
+    def sample_time(self, node, token):
+        """Draws an action's time, adding its derivatives to the token's path. Returns the time"""
+        time, derivatives = node.calc_time_and_derivatives(token.run_info.rng)
+        if len(derivatives) == 0:
+            return time
+        self.nodes[node.id] = node
+        if token.time_grads is None:
+            token.time_grads = {}
+        for param, d in derivatives.items():
+            key = (node.id, param)
+            token.time_grads[key] = token.time_grads.get(key, 0) + d
+        return time
+
+    def record_choice(self, node, token, chosen_edge):
+        """Adds the score of a decision (d log P(chosen)/d w for each edge weight w) to the run"""
+        weights = [e.probability for e in node.out_edges]
+        if None in weights:
+            return  # unweighted choices have no parameters
+        total = sum(weights)
+        scores = self.run_scores.setdefault(token.run_id, {})
+        for e in node.out_edges:
+            self.edges[e.id] = (node, e)
+            score = -1/total
+            if e is chosen_edge:
+                score += 1/e.probability
+            scores[e.id] = scores.get(e.id, 0) + score
+
+    def record_run(self, token, end_time):
+        """Called once when each run ends, with the token that ended it"""
+        grads = token.time_grads if token.time_grads is not None else {}
+        self.runs[token.run_id] = (end_time, end_time-token.creation_time, grads)
+
+    @staticmethod
+    def mean_and_error(values):
+        n = len(values)
+        mean = sum(values)/n
+        if n < 2:
+            return mean, math.inf
+        var = sum((v-mean)**2 for v in values)/(n-1)
+        return mean, math.sqrt(var/n)
+
+    def results(self):
+        """Returns the sensitivity table, ranked by elasticity (the % change in mean completion
+           time per % change in the parameter), which is comparable across parameter units"""
+        if len(self.runs) == 0:
+            return []
+        run_ids = sorted(self.runs)
+        times = [self.runs[r][1] for r in run_ids]
+        mean_time = sum(times)/len(times)
+        rows = []
+        for node_id, node in self.nodes.items():
+            for param, value in node.get_timing_params().items():
+                values = [self.runs[r][2].get((node_id, param), 0) for r in run_ids]
+                rows.append(self.make_row(node.name, param, value, values, mean_time, 'IPA'))
+        for edge_id, (node, e) in self.edges.items():
+            values = [(t-mean_time)*self.run_scores.get(r, {}).get(edge_id, 0) for r, t in zip(run_ids, times)]
+            rows.append(self.make_row(node.name, f'Probability ({e.name})', e.probability, values, mean_time, 'Likelihood Ratio'))
+        rows.sort(key=lambda x: -abs(x['Elasticity']))
+        return rows
+
+    def make_row(self, node_name, param, value, values, mean_time, method):
+        derivative, std_error = self.mean_and_error(values)
+        elasticity = derivative*value/mean_time if mean_time != 0 else 0
+        return {'node': node_name,
+                'parameter': param,
+                'value': value,
+                'dT/dparam': derivative,
+                'std_error': std_error,
+                'Elasticity': elasticity,
+                'method': method}
+
+    def log_results(self, logger, num_rows=10):
+        """Logs the most influential parameters"""
+        rows = self.results()
+        logger.log(f"Sensitivity of mean completion time over {len(self.runs)} runs (top {min(num_rows, len(rows))}):", log_time=False)
+        for row in rows[:num_rows]:
+            logger.log(f"    {row['node']} {row['parameter']}: dT/dparam = {row['dT/dparam']:.4g} "
+                       f"(+/- {row['std_error']:.3g}), elasticity {row['Elasticity']:.3g}", log_time=False)
+        return rows
@@ -0,0 +1,388 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import random
+import time
+import simpy
+
+from logger import Logger
+from builder import create_sim_graph
+from cameo_sim import CONFIG_FILE, load_config
+from invalid_model_error import InvalidModelError
+from sim import loop_create_runs_process
+from validate import check_sim_graph
+from xml_loader import load_model_data
+import psf
+
+# Long running sim service, so jobs don't each pay for interpreter startup, imports and model parsing.
+# Run with "python service.py"; settings come from the "service" section of config.json.
+# Jobs are queued, then run on a pool of worker processes. Each worker keeps its recently used
+# parsed models warm, keyed by file and modified time, so an edited model is always reparsed.
+#
+# API (JSON over HTTP, on localhost or a unix socket):
+#   POST   /jobs             submit a job, returns {"job_id": ...}. All fields are optional:
+#                            model_file, main_activity_name, number_of_runs, time_between_runs (default to config.json),
+#                            seed, overrides ({actor name: {enviroment attribute: value}}),
+#                            and psf (same as the config's "psf" section; see psf.py)
+#   GET    /jobs             status of every job
+#   GET    /jobs/<id>        status of one job, with its result once done
+#   GET    /jobs/<id>/events stream of status updates (one JSON object per line) until the job ends
+#   DELETE /jobs/<id>        cancel a queued or running job
+# ex: curl -X POST localhost:8765/jobs -d '{"number_of_runs": 100, "seed": 1}'
+
+DEFAULT_SETTINGS = {'host': '127.0.0.1',
+                    'port': 8765,
+                    'unix_socket': None,  # if set, listen on this socket path instead of host/port
+                    'workers': 2,
+                    'model_pool_size': 8,
+                    'max_queued_jobs': 100}
+# Sim steps between progress reports (and checks for cancellation) in the workers
+PROGRESS_STEPS = 2000
+JOB_FIELDS = ['model_file', 'main_activity_name', 'number_of_runs', 'time_between_runs', 'seed', 'overrides', 'psf']
+time_for_names = int(time.time())
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when its job is cancelled"""
+    pass
+
+
+# ----- Worker process side -----
+
+worker_state = {}
+
+
+def init_worker(progress_queue, cancelled, model_pool_size):
+    """Runs once in each worker process"""
+    worker_state['progress_queue'] = progress_queue
+    worker_state['cancelled'] = cancelled
+    worker_state['model_pool'] = collections.OrderedDict()
+    worker_state['model_pool_size'] = model_pool_size
+
+
+def get_model_data(xmlfile, activity_name):
+    """Loads model data through the worker's LRU pool of parsed models"""
+    pool = worker_state['model_pool']
+    key = (os.path.abspath(xmlfile), os.stat(xmlfile).st_mtime_ns, activity_name)
+    if key in pool:
+        pool.move_to_end(key)
+        return pool[key]
+    with contextlib.redirect_stdout(io.StringIO()):
+        model_data = load_model_data(xmlfile, activity_name)
+    pool[key] = model_data
+    while len(pool) > worker_state['model_pool_size']:
+        pool.popitem(last=False)
+    return model_data
+
+
+def apply_overrides(actor_infos, overrides):
+    """Sets actor enviroment values. Actors may be given by name or id"""
+    for actor_key, env_values in overrides.items():
+        matches = [a for a in actor_infos.values() if actor_key in (a['id'], a['name'])]
+        if len(matches) == 0:
+            raise InvalidModelError(f'No actor named {actor_key} to override')
+        for info in matches:
+            info['env'].update(env_values)
+
+
+def run_job(job_id, job):
+    """Runs one job to completion in a worker process. Returns a summary of the results"""
+    start = time.time()
+    progress_queue = worker_state['progress_queue']
+    node_info_dict, edge_info_list, actor_infos, sub_activity_infos = get_model_data(job['model_file'], job['main_activity_name'])
+    # Actors take their enviroment dicts by reference; keep the pooled copy untouched
+    actor_infos = copy.deepcopy(actor_infos)
+    apply_overrides(actor_infos, job['overrides'])
+    env = simpy.Environment()
+    logger = Logger(env, Logger.LOG_FILE, job['results_file'], out_file=job['log_file'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        node_dict, edge_list, start_node, actor_dict = create_sim_graph(env, logger, node_info_dict, edge_info_list, actor_infos, sub_activity_infos,
+                                                                        psf_table=psf.create_psf_table(psf.load_coefficients(job['psf'])))
+        warnings = check_sim_graph(node_dict, start_node, job['main_activity_name'])
+    if job['seed'] is not None:
+        random.seed(job['seed'])
+    logger.log('Beginning Sim', log_time=False)
+    env.process(loop_create_runs_process(env, logger, start_node, job['number_of_runs'], job['time_between_runs']))
+    # Step the sim by hand, so progress can be reported and cancellation noticed along the way
+    steps = 0
+    runs_reported = 0
+    while env.peek() != simpy.core.Infinity:
+        env.step()
+        steps += 1
+        if steps % PROGRESS_STEPS == 0:
+            if worker_state['cancelled'].get(job_id):
+                raise JobCancelled()
+            if len(logger.summary_stats) != runs_reported:
+                runs_reported = len(logger.summary_stats)
+                progress_queue.put((job_id, runs_reported))
+    logger.log_final_stats()
+    times = [s['total_time_elapsed'] for s in logger.summary_stats]
+    result = {'runs_finished': len(times),
+              'num_failed': sum(1 for s in logger.summary_stats if s['failed']),
+              'results_file': job['results_file'],
+              'log_file': job['log_file'],
+              'warnings': warnings,
+              'run_time_percentiles': logger.run_time_sketch.summary(),
+              # Mergeable with the sketches of other jobs (see sketch.py)
+              'run_time_sketch': logger.run_time_sketch.to_dict(),
+              'elapsed_seconds': time.time()-start}
+    if len(times) > 0:
+        result.update({'mean_time': sum(times)/len(times), 'min_time': min(times), 'max_time': max(times)})
+    return result
+
+
+# ----- Service side -----
+
+class Job:
+    """A submitted job, and everything sent to clients about it"""
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.state = 'queued'
+        self.runs_finished = 0
+        self.result = None
+        self.error = None
+        self.events = []
+        self.updated = asyncio.Event()
+
+    def is_finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def status(self):
+        status = {'job_id': self.id,
+                  'state': self.state,
+                  'runs_finished': self.runs_finished,
+                  'number_of_runs': self.params['number_of_runs']}
+        if self.result is not None:
+            status['result'] = self.result
+        if self.error is not None:
+            status['error'] = self.error
+        return status
+
+    def update(self, **changes):
+        """Changes the job's status, waking up anyone streaming its events"""
+        for k, v in changes.items():
+            setattr(self, k, v)
+        self.events.append(self.status())
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class SimService:
+    """Queues jobs and runs them on a process pool, serving the JSON API"""
+    def __init__(self, defaults, workers=2, model_pool_size=8, max_queued_jobs=100):
+        self.defaults = defaults
+        self.workers = workers
+        self.model_pool_size = model_pool_size
+        self.queue = asyncio.Queue(max_queued_jobs)
+        self.jobs = {}
+        self.next_job_id = 0
+
+    async def start(self):
+        self.manager = multiprocessing.Manager()
+        self.progress_queue = self.manager.Queue()
+        self.cancelled = self.manager.dict()
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, initializer=init_worker,
+                                                           initargs=(self.progress_queue, self.cancelled, self.model_pool_size))
+        # One dispatcher per worker, so at most that many jobs run at once
+        self.tasks = [asyncio.create_task(self.dispatch()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.pump_progress()))
+
+    def stop(self):
+        # With the dispatchers stopped, no more jobs reach the pool; running ones are told to stop
+        for task in self.tasks:
+            task.cancel()
+        for job in self.jobs.values():
+            if job.state == 'running':
+                self.cancelled[job.id] = True
+        self.progress_queue.put(None)
+        self.pool.shutdown()
+        self.manager.shutdown()
+
+    def submit(self, request):
+        """Queues a job from a request body. Returns the Job"""
+        unknown = set(request) - set(JOB_FIELDS)
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown job fields: {sorted(unknown)}')
+        params = {k: request.get(k, self.defaults.get(k)) for k in JOB_FIELDS}
+        if params['overrides'] is None:
+            params['overrides'] = {}
+        if params['model_file'] is None or params['main_activity_name'] is None:
+            raise ValueError('model_file and main_activity_name are needed')
+        if not isinstance(params['number_of_runs'], int) or params['number_of_runs'] < 1:
+            raise ValueError('number_of_runs must be a positive integer')
+        job_id = str(self.next_job_id)
+        params['results_file'] = f'Results/Results_Job{job_id}_{time_for_names}.xlsx'
+        params['log_file'] = f'Results/Log_Job{job_id}_{time_for_names}.txt'
+        job = Job(job_id, params)
+        self.queue.put_nowait(job)  # raises QueueFull when at the limit
+        self.next_job_id += 1
+        self.jobs[job_id] = job
+        job.update()
+        return job
+
+    def cancel(self, job):
+        if job.is_finished():
+            return
+        if job.state == 'running':
+            # The worker notices this on its next progress check
+            self.cancelled[job.id] = True
+        else:
+            job.update(state='cancelled')
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.state != 'queued':
+                continue  # cancelled while queued
+            job.update(state='running')
+            try:
+                result = await loop.run_in_executor(self.pool, run_job, job.id, job.params)
+                job.update(state='done', result=result, runs_finished=result['runs_finished'])
+            except JobCancelled:
+                job.update(state='cancelled')
+            except asyncio.CancelledError:
+                raise  # the service is stopping (before 3.8 this is an Exception too)
+            except Exception as e:
+                job.update(state='failed', error=f'{type(e).__name__}: {e}')
+            # A cancel may have been asked for (even if the job finished first); it is no longer needed
+            self.cancelled.pop(job.id, None)
+
+    async def pump_progress(self):
+        """Forwards progress reports from the workers to the jobs"""
+        loop = asyncio.get_running_loop()
+        while True:
+            msg = await loop.run_in_executor(None, self.progress_queue.get)
+            if msg is None:
+                return
+            job_id, runs_finished = msg
+            job = self.jobs.get(job_id)
+            if job is not None and job.state == 'running':
+                job.update(runs_finished=runs_finished)
+
+    # ----- HTTP -----
+
+    async def handle_connection(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if line == '':
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            if len(request_line) < 2:
+                await self.respond(writer, 400, {'error': 'Bad request'})
+                return
+            await self.route(writer, request_line[0], request_line[1], body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, body):
+        parts = [p for p in path.split('?')[0].split('/') if p != '']
+        if parts == ['jobs'] and method == 'POST':
+            try:
+                request = json.loads(body) if len(body) > 0 else {}
+                if not isinstance(request, dict):
+                    raise ValueError('Job must be a JSON object')
+                job = self.submit(request)
+            except ValueError as e:  # includes bad JSON
+                await self.respond(writer, 400, {'error': str(e)})
+                return
+            except asyncio.QueueFull:
+                await self.respond(writer, 503, {'error': 'Too many queued jobs'})
+                return
+            await self.respond(writer, 201, {'job_id': job.id})
+        elif parts == ['jobs'] and method == 'GET':
+            await self.respond(writer, 200, [j.status() for j in self.jobs.values()])
+        elif len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.jobs.get(parts[1])
+            if job is None:
+                await self.respond(writer, 404, {'error': f'No job {parts[1]}'})
+            elif len(parts) == 2 and method == 'GET':
+                await self.respond(writer, 200, job.status())
+            elif len(parts) == 2 and method == 'DELETE':
+                self.cancel(job)
+                await self.respond(writer, 202, job.status())
+            elif parts[2] == 'events' and method == 'GET':
+                await self.stream_events(writer, job)
+            else:
+                await self.respond(writer, 404, {'error': 'Not found'})
+        else:
+            await self.respond(writer, 404, {'error': 'Not found'})
+
+    async def respond(self, writer, code, data):
+        body = json.dumps(data).encode()
+        writer.write(f'HTTP/1.1 {code} {HTTP_REASONS[code]}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    async def stream_events(self, writer, job):
+        """Sends every status update of the job as a line of JSON, until the job ends"""
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                     b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+        sent = 0
+        while True:
+            updated = job.updated
+            for event in job.events[sent:]:
+                data = (json.dumps(event) + '\n').encode()
+                writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+            sent = len(job.events)
+            await writer.drain()
+            if job.is_finished():
+                break
+            await updated.wait()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+HTTP_REASONS = {200: 'OK', 201: 'Created', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 503: 'Service Unavailable'}
+
+
+async def serve(settings, defaults):
+    service = SimService(defaults, settings['workers'], settings['model_pool_size'], settings['max_queued_jobs'])
+    await service.start()
+    if settings['unix_socket'] is not None:
+        server = await asyncio.start_unix_server(service.handle_connection, settings['unix_socket'])
+        print(f"Sim service listening on {settings['unix_socket']}")
+    else:
+        server = await asyncio.start_server(service.handle_connection, settings['host'], settings['port'])
+        print(f"Sim service listening on http://{settings['host']}:{settings['port']}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.stop()
+
+
+def main():
+    xmlfile, activity_diagram_name, time_between_runs, num_runs, options = load_config(CONFIG_FILE)
+    settings = dict(DEFAULT_SETTINGS)
+    if options['service'] is not None:
+        settings.update(options['service'])
+    defaults = {'model_file': xmlfile,
+                'main_activity_name': activity_diagram_name,
+                'number_of_runs': num_runs,
+                'time_between_runs': time_between_runs,
+                'seed': options['seed'],
+                'psf': options['psf']}
+    os.makedirs('Results', exist_ok=True)
+    try:
+        asyncio.run(serve(settings, defaults))
+    except KeyboardInterrupt:
+        print('Sim service stopped')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,34 @@
+import random
 import exec_token
 
-def loop_create_runs_process(env, logger, start_node, num_runs, run_delay):
+
+def new_run_rng():
+    """Each run draws its random numbers from its own generator, seeded with one draw from the global one.
+       So a run's results only depend on the global seed and how many runs came before it,
+       not on which other runs happen to overlap it"""
+    return random.Random(random.getrandbits(64))
+
+
+def skip_runs(num_runs):
+    """Advances the global generator past num_runs runs, as if they had been started"""
+    for _ in range(num_runs):
+        random.getrandbits(64)
+        
+
+def loop_create_runs_process(env, logger, start_node, num_runs, run_delay, first_run_id=0, checkpointer=None, start_time=None):
     """Creates new runs periodically, insead of all at once
        This may make for cleaner logs"""
-    for run_id in range(num_runs):
+    if start_time is not None and start_time > env.now:
+        # Resuming; runs continue at the sim time they left off at
+        yield env.timeout(start_time-env.now)
+    for run_id in range(first_run_id, first_run_id+num_runs):
+        if checkpointer is not None:
+            checkpointer.maybe_save(env, logger, run_id)
         logger.log(f"Beginning run {run_id}.")
-        yield env.process(start_node.run(exec_token.ExecToken(creation_time=env.now, run_id=run_id)))
+        token = exec_token.ExecToken(creation_time=env.now, run_id=run_id, run_info=exec_token.RunInfo(new_run_rng()))
+        if logger.trace is not None:
+            logger.trace.record_run_start(token, start_node)
+        yield env.process(start_node.run(token))
         yield env.timeout(run_delay)
         
         
@@ -14,9 +37,33 @@ def create_many_runs(env, logger, start_node, num_runs):
     loop_create_runs_process(env, logger, start_node, num_runs, run_delay=0)
     
     
-def start_sim(env, logger, start_node, num_runs, time_between_runs):
+def start_sim(env, logger, start_node, num_runs, time_between_runs, first_run_id=0, checkpointer=None, start_time=None):
     """Start up the sim with the start node"""
     logger.log('Beginning Sim', log_time=False)
-    env.process(loop_create_runs_process(env, logger, start_node, num_runs, time_between_runs))
+    env.process(loop_create_runs_process(env, logger, start_node, num_runs, time_between_runs, first_run_id, checkpointer, start_time))
     env.run()
-    logger.log_final_stats()
\ No newline at end of file
+    logger.log_final_stats()
+    
+    
+def start_cached_sim(env, logger, start_node, num_runs, time_between_runs, cache, key, seed):
+    """Same as start_sim, but reuses runs from the result cache.
+       Only runs missing from the cache are simulated, and are then added to it.
+       Runs have their own generators (see new_run_rng), so cached runs and extensions match one fresh sim exactly"""
+    cached = cache.load(key)
+    num_cached = 0
+    if cached is not None:
+        cached_num_runs, summary_stats, run_details = cached
+        num_cached = min(num_runs, cached_num_runs)
+        logger.load_runs([s for s in summary_stats if s['run_id'] < num_cached], {r: run_details[r] for r in run_details if r < num_cached})
+        logger.log(f'Loaded {num_cached} runs from the result cache', log_time=False)
+    if num_cached == num_runs:
+        logger.log_final_stats()
+        return
+    # Continue where the cached runs left off: the same generator state, and the same start times
+    random.seed(seed)
+    skip_runs(num_cached)
+    start_time = 0
+    for _ in range(num_cached):
+        start_time += time_between_runs  # added up one run at a time like the sim clock, so times match exactly
+    start_sim(env, logger, start_node, num_runs-num_cached, time_between_runs, first_run_id=num_cached, start_time=start_time)
+    cache.store(key, num_runs, logger.summary_stats, logger.run_details)
\ No newline at end of file
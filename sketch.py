@@ -0,0 +1,114 @@
+import math
+
+# Streaming quantile sketches, so percentiles of run and node times need constant memory
+# however many runs there are.
+# Values go into logarithmically sized bins (as in DDSketch): every value in a bin is within
+# relative_accuracy of the bin's representative value, so any quantile is reported to within
+# that relative error. Bins are plain counts, so two sketches with the same accuracy merge
+# exactly by adding counts (ex: sketches from parallel workers).
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+class QuantileSketch:
+    """Mergeable quantile sketch of non-negative values.
+       If more than max_bins are ever needed, the lowest bins are combined (losing accuracy only there)"""
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1+relative_accuracy)/(1-relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}  # bin index -> count
+        self.zero_count = 0  # zero (and tiny) values, ex: control nodes that take no time
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise Exception(f'Sketches only hold non-negative values; got {value}')
+        self.count += count
+        self.total += value*count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < 1e-9:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value)/self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def collapse(self):
+        """Combines the lowest bins until the sketch fits in max_bins"""
+        indices = sorted(self.bins)
+        extra = indices[:len(indices)-self.max_bins]
+        merged = sum(self.bins.pop(i) for i in extra)
+        target = indices[len(extra)]
+        self.bins[target] += merged
+
+    def merge(self, other):
+        """Adds every value of another sketch (with the same accuracy) into this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise Exception('Only sketches with the same relative accuracy can be merged')
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        while len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def quantile(self, q):
+        """Estimated value at quantile q (0 to 1), or None if the sketch is empty"""
+        if self.count == 0:
+            return None
+        rank = q*(self.count-1)
+        seen = self.zero_count
+        if rank < seen:
+            return self.min
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                value = 2*self.gamma**index/(self.gamma+1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total/self.count if self.count > 0 else None
+
+    def summary(self, percentiles=PERCENTILES):
+        """Count, mean, min, max and the given percentiles, as a dict"""
+        row = {'count': self.count,
+               'mean': self.mean(),
+               'min': self.min if self.count > 0 else None}
+        for p in percentiles:
+            row[f'p{p}'] = self.quantile(p/100)
+        row['max'] = self.max if self.count > 0 else None
+        return row
+
+    def to_dict(self):
+        """JSON-safe form, for sending between processes or saving"""
+        return {'relative_accuracy': self.relative_accuracy,
+                'max_bins': self.max_bins,
+                'bins': [[i, c] for i, c in self.bins.items()],
+                'zero_count': self.zero_count,
+                'count': self.count,
+                'total': self.total,
+                'min': self.min if self.count > 0 else None,
+                'max': self.max if self.count > 0 else None}
+
+    @staticmethod
+    def from_dict(data):
+        sketch = QuantileSketch(data['relative_accuracy'], data['max_bins'])
+        sketch.bins = {i: c for i, c in data['bins']}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.total = data['total']
+        if sketch.count > 0:
+            sketch.min = data['min']
+            sketch.max = data['max']
+        return sketch
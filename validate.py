@@ -0,0 +1,182 @@
+import collections
+
+import nodes
+import edge
+from invalid_model_error import InvalidModelError
+
+# Pre-flight validation of a built sim graph.
+# Many model mistakes only show up mid-run, if at all (ex: a join that waits forever).
+# These checks walk each activity graph once, so every problem is reported up front,
+# before any runs are spent.
+
+
+def successors(node):
+    """Every edge a token may leave the node by"""
+    out = list(node.out_edges)
+    if getattr(node, 'fail_edge', None) is not None:
+        out.append(node.fail_edge)
+    return out
+
+
+class GraphValidator:
+    """Collects errors (runs would crash, hang or lose tokens) and warnings (likely mistakes) for a graph"""
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def validate_sim_graph(self, node_dict, start_node, activity_name='Main activity'):
+        """Checks the main activity, then every sub-activity called from it"""
+        checked_templates = set()
+        to_check = [(activity_name, node_dict, start_node)]
+        while len(to_check) > 0:
+            name, act_nodes, act_start = to_check.pop()
+            self.validate_activity(name, act_nodes, act_start, is_main=act_nodes is node_dict)
+            for node in act_nodes.values():
+                if isinstance(node, nodes.CallActivityNode) and node.template.id not in checked_templates:
+                    checked_templates.add(node.template.id)
+                    to_check.append((node.template.name, node.template.node_dict, node.template.start_node))
+        return self.errors, self.warnings
+
+    def validate_activity(self, activity_name, node_dict, start_node, is_main=True):
+        # A final node ends the whole run in the main activity, but only the current call in a sub-activity
+        ends = 'the run ends' if is_main else 'the call returns'
+        def error(msg):
+            self.errors.append(f'{activity_name}: {msg}')
+
+        def warn(msg):
+            self.warnings.append(f'{activity_name}: {msg}')
+
+        if start_node is None:
+            # Nothing to walk from, but the nodes can still be checked one at a time
+            error('No initial node; runs could never start')
+            for node in node_dict.values():
+                if not isinstance(node, nodes.FinalNode):
+                    self.check_node(node, error, warn)
+            return
+
+        # Fork nesting: the stack of fork ids a token carries on arriving at each node
+        stacks = {start_node.id: ()}
+        # fork id -> ids of joins that close it; join id -> ids of forks it closes
+        fork_joins = collections.defaultdict(set)
+        join_forks = collections.defaultdict(set)
+        final_stacks = []  # (final node, stack) for every way a final is reached inside a fork
+        reported = set()  # node ids already reported for bad nesting
+        sources = collections.defaultdict(list)  # node id -> nodes with an edge into it
+        queue = collections.deque([start_node])
+        while len(queue) > 0:
+            node = queue.popleft()
+            stack = stacks[node.id]
+            if isinstance(node, nodes.FinalNode):
+                continue
+            self.check_node(node, error, warn)
+            for i, e in enumerate(successors(node)):
+                target = e.next_node
+                if target is None:
+                    continue
+                sources[target.id].append(node)
+                next_stack = stack
+                if isinstance(node, nodes.ForkNode) and i < len(node.out_edges):
+                    next_stack = stack + (node.id,)
+                if isinstance(target, nodes.JoinNode):
+                    if len(next_stack) == 0:
+                        if target.id not in reported:
+                            reported.add(target.id)
+                            error(f'Join {target.name} can be reached without a previous fork; runs reaching it will crash')
+                    else:
+                        fork_joins[next_stack[-1]].add(target.id)
+                        join_forks[target.id].add(next_stack[-1])
+                        next_stack = next_stack[:-1]
+                if isinstance(target, nodes.FinalNode):
+                    # Finals may be reached from anywhere; ending inside a fork is checked below
+                    if len(next_stack) > 0:
+                        final_stacks.append((target, next_stack))
+                    if target.id not in stacks:
+                        stacks[target.id] = ()
+                        queue.append(target)
+                elif target.id not in stacks:
+                    stacks[target.id] = next_stack
+                    queue.append(target)
+                elif stacks[target.id] != next_stack and target.id not in reported:
+                    reported.add(target.id)
+                    error(f'{target.name} is reached from inside different forks; its tokens cannot be joined correctly')
+
+        for join_id, fork_ids in join_forks.items():
+            if len(fork_ids) > 1:
+                names = sorted(node_dict[f].name for f in fork_ids)
+                error(f'Join {node_dict[join_id].name} closes more than one fork ({", ".join(names)}); it would never see a full set of tokens')
+        for fork_id, join_ids in fork_joins.items():
+            fork = node_dict[fork_id]
+            if len(join_ids) > 1:
+                names = sorted(node_dict[j].name for j in join_ids)
+                error(f'Branches of fork {fork.name} end at different joins ({", ".join(names)}); none of them would see a full set of tokens')
+            if len(fork.out_edges) < 2:
+                warn(f'Fork {fork.name} has only {len(fork.out_edges)} outgoing edge')
+        for final, stack in final_stacks:
+            for fork_id in set(stack):
+                fork = node_dict[fork_id]
+                if fork_id in fork_joins:
+                    warn(f'A branch of fork {fork.name} can reach {final.name} without passing its join; {ends} there, and the other branches are dropped')
+                elif final.id not in reported:
+                    reported.add(final.id)
+                    warn(f'Branches of fork {fork.name} are never joined; {ends} when the first branch reaches {final.name}')
+
+        # Every reached node should be able to reach a final node
+        reached = set(stacks)
+        can_finish = set()
+        queue = collections.deque(n_id for n_id in reached if isinstance(node_dict[n_id], nodes.FinalNode))
+        can_finish.update(queue)
+        while len(queue) > 0:
+            n_id = queue.popleft()
+            for source in sources[n_id]:
+                if source.id not in can_finish:
+                    can_finish.add(source.id)
+                    queue.append(source.id)
+        if len(can_finish) == 0:
+            error('No final node can be reached from the initial node')
+        else:
+            for n_id in node_dict:
+                if n_id in reached and n_id not in can_finish and len(node_dict[n_id].out_edges) > 0:  # dead ends are already reported
+                    error(f'No final node can be reached from {node_dict[n_id].name}; runs reaching it never finish')
+
+        for n_id, node in node_dict.items():
+            if n_id not in reached:
+                if isinstance(node, nodes.AcceptSignalNode):
+                    warn(f'Signal acceptor {node.name} never receives a signal')
+                else:
+                    warn(f'{node.name} can never be reached from the initial node')
+
+    def check_node(self, node, error, warn):
+        """Checks that only need the node itself and its outgoing edges"""
+        if len(node.out_edges) == 0:
+            error(f'{node.name} has no outgoing edges; runs reaching it will crash')
+        if isinstance(node, nodes.DecisionNode):
+            self.check_decision(node, error)
+        for e in successors(node):
+            if e.next_node is None:
+                error(f'Edge {e.name} from {node.name} leads nowhere')
+            elif isinstance(e, edge.SignalEdge) and not isinstance(e.next_node, nodes.AcceptSignalNode):
+                error(f'Signal edge {e.name} leads to {e.next_node.name}, which does not accept signals')
+        if isinstance(node, nodes.SendSignalNode) and not any(isinstance(e, edge.SignalEdge) for e in node.out_edges):
+            warn(f'Signal sender {node.name} has no acceptor for its signal')
+
+    def check_decision(self, node, error):
+        weights = [e.probability for e in node.out_edges]
+        num_none = weights.count(None)
+        if 0 < num_none < len(weights):
+            error(f'Decision {node.name} has probabilities on only some of its edges; give all of them or none')
+        elif num_none == 0 and len(weights) > 0:
+            if any(w < 0 for w in weights):
+                error(f'Decision {node.name} has a negative probability')
+            elif sum(weights) <= 0:
+                error(f'Decision {node.name} has probabilities that add up to 0')
+
+
+def check_sim_graph(node_dict, start_node, activity_name='Main activity'):
+    """Validates the graph, printing every problem found.
+       Raises an InvalidModelError listing all of the errors, if there are any"""
+    errors, warnings = GraphValidator().validate_sim_graph(node_dict, start_node, activity_name)
+    for w in warnings:
+        print(f'Warning: {w}')
+    if len(errors) > 0:
+        raise InvalidModelError(f'{len(errors)} problem(s) found in the model:\n' + '\n'.join(f'    {e}' for e in errors))
+    return warnings
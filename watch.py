@@ -0,0 +1,258 @@
+import contextlib
+import io
+import os
+import time
+import simpy
+
+import builder
+import psf
+from cameo_sim import CONFIG_FILE, load_config
+from invalid_model_error import InvalidModelError
+from logger import Logger
+from sim import loop_create_runs_process
+from validate import check_sim_graph
+from xml_loader import load_model_data
+
+# Watch mode: re-exporting a model from Cameo reloads it, updates only the parts of the
+# graph that changed, and re-runs a quick smoke batch of runs.
+# Run with "python watch.py"; settings come from the "watch" section of config.json
+
+DEFAULT_SMOKE_RUNS = 20
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+def edge_key(edge_info):
+    """Edges are identified by id and endpoints, since signal edges share the id of their event"""
+    return (edge_info['id'], edge_info['source_id'], edge_info['target_id'])
+
+
+class GraphState:
+    """The built nodes and edges of one activity (the main one, or a sub-activity template),
+       along with the loaded info they were built from"""
+    def __init__(self, node_info_dict, edge_info_list, node_dict, edge_list, start_node):
+        self.node_info_dict = node_info_dict
+        self.edge_infos = {edge_key(e): e for e in edge_info_list}
+        self.node_dict = node_dict
+        self.edge_dict = {edge_key(e): built for e, built in zip(edge_info_list, edge_list)}
+        self.start_node = start_node
+
+
+class ModelWatcher:
+    """Keeps a built sim graph in sync with a model file, and smoke tests it after each change"""
+    def __init__(self, xmlfile, activity_name, log_file, smoke_runs=DEFAULT_SMOKE_RUNS, time_between_runs=0,
+                 poll_interval=DEFAULT_POLL_INTERVAL, psf_coefficients=None):
+        self.xmlfile = xmlfile
+        self.activity_name = activity_name
+        self.log_file = log_file
+        self.smoke_runs = smoke_runs
+        self.time_between_runs = time_between_runs
+        self.poll_interval = poll_interval
+        self.psf_coefficients = psf_coefficients
+        self.last_mtime = None
+        self.main = None
+
+    def load(self):
+        """Parses the model file, without the loader's printing"""
+        with contextlib.redirect_stdout(io.StringIO()):
+            return load_model_data(self.xmlfile, self.activity_name)
+
+    def full_build(self, model_data):
+        """Builds everything from scratch, with a fresh enviroment"""
+        node_info_dict, edge_info_list, actor_infos, sub_activity_infos = model_data
+        self.env = simpy.Environment()
+        self.logger = Logger(self.env, Logger.LOG_FILE, '', out_file=self.log_file)
+        self.psf_table = psf.create_psf_table(self.psf_coefficients)
+        self.next_run_id = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.actor_infos = actor_infos
+            self.actor_dict = builder.create_actors(actor_infos)
+            self.sub_activity_infos = sub_activity_infos
+            self.templates = builder.create_activity_templates(self.env, self.logger, sub_activity_infos, self.actor_dict, self.psf_table)
+            node_dict, edge_list, start_node = builder.connect_graph(self.env, self.logger, node_info_dict, edge_info_list,
+                                                                     self.actor_dict, self.templates, self.psf_table)
+        self.main = GraphState(node_info_dict, edge_info_list, node_dict, edge_list, start_node)
+        self.template_states = {}
+        for act_id, t in self.templates.items():
+            info = sub_activity_infos[act_id]
+            self.template_states[act_id] = GraphState(info['node_info_dict'], info['edge_info_list'], t.node_dict, t.edge_list, t.start_node)
+
+    def update_actors(self, actor_infos):
+        """Applies actor changes. Enviroment changes go through set_env, so cached PSF values are invalidated.
+           Returns the ids of actors that were added or removed"""
+        changed = set()
+        for actor_id in actor_infos:
+            info = actor_infos[actor_id]
+            if actor_id not in self.actor_dict:
+                self.actor_dict[actor_id] = builder.Actor(actor_id, info['name'], info['env'])
+                changed.add(actor_id)
+                continue
+            actor = self.actor_dict[actor_id]
+            actor.name = info['name']
+            for attrib, value in info['env'].items():
+                if actor.perv_env.get(attrib) != value:
+                    actor.set_env(attrib, value)
+        for actor_id in list(self.actor_dict):
+            if actor_id not in actor_infos:
+                del self.actor_dict[actor_id]
+                changed.add(actor_id)
+        self.actor_infos = actor_infos
+        return changed
+
+    def update_graph(self, state, node_info_dict, edge_info_list, forced_node_ids):
+        """Rebuilds only the nodes whose info changed (or that are in forced_node_ids) and the
+           edges touching them, reusing everything else. Returns (nodes rebuilt, edges rebuilt)"""
+        changed_nodes = set(forced_node_ids) & set(node_info_dict)
+        for n_id in node_info_dict:
+            if state.node_info_dict.get(n_id) != node_info_dict[n_id]:
+                changed_nodes.add(n_id)
+        for n_id in set(state.node_dict) - set(node_info_dict):
+            del state.node_dict[n_id]
+        for n_id in changed_nodes:
+            state.node_dict[n_id] = builder.build_node(node_info_dict[n_id], self.env, self.logger, self.actor_dict, self.templates, self.psf_table)
+        new_edge_infos = {edge_key(e): e for e in edge_info_list}
+        # Nodes whose outgoing edges need to be reconnected
+        rewire_sources = set(changed_nodes)
+        edges_rebuilt = 0
+        for key in set(state.edge_dict) - set(new_edge_infos):
+            rewire_sources.add(key[1])
+            del state.edge_dict[key]
+        for key, e in new_edge_infos.items():
+            if state.edge_infos.get(key) != e:
+                state.edge_dict[key] = builder.build_edge(e, self.env, self.logger)
+                rewire_sources.add(e['source_id'])
+                edges_rebuilt += 1
+                state.edge_dict[key].set_next_node(state.node_dict[e['target_id']])
+            elif e['target_id'] in changed_nodes:
+                state.edge_dict[key].set_next_node(state.node_dict[e['target_id']])
+        for n_id in rewire_sources & set(state.node_dict):
+            state.node_dict[n_id].out_edges = []
+        # Reconnect in model order, so choices and forks keep the same edge order as a full build
+        for key, e in new_edge_infos.items():
+            if e['source_id'] in rewire_sources:
+                state.node_dict[e['source_id']].add_connection(state.edge_dict[key])
+        state.node_info_dict = node_info_dict
+        state.edge_infos = new_edge_infos
+        builder.label_call_sites(state.node_dict)
+        start_nodes = [state.node_dict[n] for n in node_info_dict if node_info_dict[n]['type'] == 'uml:InitialNode']
+        if len(start_nodes) != 1:
+            raise InvalidModelError(f"Exactly one InitialNode must be present; {len(start_nodes)} found.")
+        state.start_node = start_nodes[0]
+        return len(changed_nodes), edges_rebuilt
+
+    def nodes_using(self, node_info_dict, actor_ids, activity_ids):
+        """Ids of nodes allocated to any of the actors, or calling any of the activities"""
+        return {n_id for n_id, info in node_info_dict.items()
+                if info['actor_id'] in actor_ids or info.get('called_activity_id') in activity_ids}
+
+    def incremental_build(self, model_data):
+        """Updates the existing graph to match the new model data. Returns (nodes rebuilt, edges rebuilt)"""
+        node_info_dict, edge_info_list, actor_infos, sub_activity_infos = model_data
+        changed_actors = self.update_actors(actor_infos)
+        # Sub-activities that appeared or vanished change how their callers are built
+        added = set(sub_activity_infos) - set(self.templates)
+        removed = set(self.templates) - set(sub_activity_infos)
+        for act_id in removed:
+            del self.templates[act_id]
+            del self.template_states[act_id]
+        for act_id in added:
+            self.templates[act_id] = builder.ActivityTemplate(act_id, sub_activity_infos[act_id]['name'])
+        totals = [0, 0]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for act_id in added:
+                info = sub_activity_infos[act_id]
+                t = self.templates[act_id]
+                t.node_dict, t.edge_list, t.start_node = builder.connect_graph(self.env, self.logger, info['node_info_dict'], info['edge_info_list'],
+                                                                               self.actor_dict, self.templates, self.psf_table)
+                self.template_states[act_id] = GraphState(info['node_info_dict'], info['edge_info_list'], t.node_dict, t.edge_list, t.start_node)
+                totals[0] += len(t.node_dict)
+                totals[1] += len(t.edge_list)
+            for act_id in set(sub_activity_infos) - added:
+                info = sub_activity_infos[act_id]
+                state = self.template_states[act_id]
+                t = self.templates[act_id]
+                t.name = info['name']
+                forced = self.nodes_using(info['node_info_dict'], changed_actors, added | removed)
+                counts = self.update_graph(state, info['node_info_dict'], info['edge_info_list'], forced)
+                # Templates are shared by reference, so updating in place updates every call site
+                t.node_dict, t.start_node = state.node_dict, state.start_node
+                t.edge_list = list(state.edge_dict.values())
+                totals = [totals[0]+counts[0], totals[1]+counts[1]]
+            forced = self.nodes_using(node_info_dict, changed_actors, added | removed)
+            counts = self.update_graph(self.main, node_info_dict, edge_info_list, forced)
+        self.sub_activity_infos = sub_activity_infos
+        return totals[0]+counts[0], totals[1]+counts[1]
+
+    def smoke_test(self):
+        """Runs a quick batch of runs on the current graph, printing a short summary"""
+        self.logger.clear_results()
+        self.env.process(loop_create_runs_process(self.env, self.logger, self.main.start_node, self.smoke_runs,
+                                                  self.time_between_runs, self.next_run_id))
+        self.env.run()
+        self.next_run_id += self.smoke_runs
+        times = self.logger.run_time_sketch.summary()
+        if times['count'] == 0:
+            print('    Smoke test: no runs finished!')
+            return
+        failed = sum(1 for s in self.logger.summary_stats if s['failed'])
+        print(f"    Smoke test: {self.smoke_runs} runs, time mean {times['mean']:.4g}, "
+              f"min {times['min']:.4g}, p95 {times['p95']:.4g}, max {times['max']:.4g}, {failed} failed")
+
+    def reload(self):
+        """Reloads the model and smoke tests it. Falls back to a full rebuild if anything goes wrong"""
+        start = time.time()
+        try:
+            model_data = self.load()
+        except Exception as e:
+            print(f'Could not load model: {type(e).__name__}: {e}')
+            return
+        try:
+            if self.main is None:
+                self.full_build(model_data)
+                print(f'Built model in {(time.time()-start)*1000:.0f} ms')
+            else:
+                nodes_rebuilt, edges_rebuilt = self.incremental_build(model_data)
+                print(f'Reloaded model in {(time.time()-start)*1000:.0f} ms: {nodes_rebuilt} nodes, {edges_rebuilt} edges rebuilt')
+            check_sim_graph(self.main.node_dict, self.main.start_node, self.activity_name)
+            self.smoke_test()
+        except Exception as e:
+            # The graph or enviroment may be half updated; start over from a clean build next time
+            print(f'Error: {type(e).__name__}: {e}')
+            self.main = None
+            return
+        print(f'    Edit to result: {(time.time()-start)*1000:.0f} ms')
+
+    def check(self):
+        """Reloads if the model file has changed since last checked. Returns whether it did"""
+        try:
+            mtime = os.stat(self.xmlfile).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.last_mtime:
+            return False
+        self.last_mtime = mtime
+        self.reload()
+        return True
+
+    def watch(self):
+        """Polls the model file until interrupted"""
+        print(f'Watching {self.xmlfile} (Ctrl-C to stop)')
+        try:
+            while True:
+                self.check()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            print('Stopped watching')
+
+
+def main():
+    xmlfile, activity_diagram_name, time_between_runs, num_runs, options = load_config(CONFIG_FILE)
+    # Keys are ModelWatcher's smoke_runs and poll_interval
+    watch_options = options['watch'] if options['watch'] is not None else {}
+    log_file = f'Results/Watch_Log_{activity_diagram_name}.txt'
+    watcher = ModelWatcher(xmlfile, activity_diagram_name, log_file, time_between_runs=time_between_runs,
+                           psf_coefficients=psf.load_coefficients(options['psf']), **watch_options)
+    watcher.watch()
+
+
+if __name__ == "__main__":
+    main()
@@ -134,9 +134,13 @@ def get_nodes(activity, all_activities, activity_allocations):
                 except KeyError:
                     # Otherwise, error.
                     raise InvalidModelError(f'{node_info["type"]} Not Allocated. All Performance Actions must be Allocated to an Actor, or be in an Activity that itself is allocated.')
-            # else, its not a perf action so behavior/actor is not relevant
-            behavior_id = None
-            actor_id = None
+            else:
+                # its not a perf action so behavior/actor is not relevant
+                behavior_id = None
+                actor_id = None
+        # The called activity is kept seperately from behavior_id (which is only used for naming),
+        # so actions whose behavior has its own diagram can be expanded as sub-activities
+        node_info['called_activity_id'] = n.attrib.get('behavior')
         # Give The node a name, using a priority based on whats availible:
         #     First try the actual nodes name
         #     Then the activity it represents, if it exists
@@ -199,10 +203,18 @@ def apply_node_stereotypes(root, node_info_dict):
             node_info_dict[n_id]['TTC'] = None
         print(f'    TTC == {node_info_dict[n_id]["TTC"]}')
         try:
-            node_info_dict[n_id]['PerformanceEnable'] = stereo.attrib['PSF_Enable']
+            node_info_dict[n_id]['PerformanceEnable'] = stereo.attrib['Performance_Enable']
         except KeyError:
-            node_info_dict[n_id]['PerformanceEnable'] = None
+            # Older profiles named this PSF_Enable
+            node_info_dict[n_id]['PerformanceEnable'] = stereo.attrib.get('PSF_Enable')
         print(f'    PerformanceEnable == {node_info_dict[n_id]["PerformanceEnable"]}')
+        try:
+            node_info_dict[n_id]['Failure_Probability'] = float(stereo.attrib['Failure_Probability'])
+        except KeyError:
+            node_info_dict[n_id]['Failure_Probability'] = 0
+        except ValueError:
+            raise InvalidModelError(f'{n_name}: Failure_Probability not a number')
+        print(f'    Failure_Probability == {node_info_dict[n_id]["Failure_Probability"]}')
         node_info_dict[n_id]['perf'] = {}
         for attrib in PERF_ATTRIBS:
             try:
@@ -354,14 +366,8 @@ def assemble_signal_edges(accept_signal_connections, send_signal_connections, si
     return signal_edge_info_list
     
     
-def load_model_data(xmlfile, ActivityDiagramName):
-    """Extracts all relevant data from the model and organizes it into several containers"""
-    tree = ET.parse(xmlfile)
-    root = tree.getroot()
-    activity, all_activities = get_activities(root, ActivityDiagramName)
-    # Actors
-    actor_infos = get_actors(root)
-    activity_allocations = get_actor_allocations(root, actor_infos, all_activities)
+def load_activity_data(root, activity, all_activities, activity_allocations, signal_events):
+    """Extracts the nodes and edges (including signal edges) of a single activity"""
     # Nodes
     node_info_dict, accept_signal_connections, send_signal_connections = get_nodes(activity, all_activities, activity_allocations)
     node_info_dict = apply_node_stereotypes(root, node_info_dict)
@@ -369,10 +375,55 @@ def load_model_data(xmlfile, ActivityDiagramName):
     # Edges
     edge_probabilites = get_edge_probabilities(root, activity)
     edge_info_list = get_edges(activity, edge_probabilites)
-    
-    signals = get_signals(root)
-    signal_events = get_signal_events(root, signals)
     signal_edge_info_list = assemble_signal_edges(accept_signal_connections, send_signal_connections, signal_events)
     # combine edge lists
     edge_info_list = edge_info_list + signal_edge_info_list
-    return node_info_dict, edge_info_list, actor_infos
\ No newline at end of file
+    return node_info_dict, edge_info_list
+
+
+def is_sub_activity(activity):
+    """Activities with their own diagram (an inner set of nodes) are simulated as sub-activities.
+       Ones without nodes are plain actions, and only used for naming and allocation"""
+    return activity.find('node') is not None
+
+
+def load_sub_activities(root, node_info_dict, all_activities, activity_allocations, signal_events, sub_activity_infos):
+    """Finds every activity called from the given nodes that has its own diagram, and parses it.
+       Each distinct activity is parsed exactly once, no matter how many actions call it.
+       sub_activity_infos is keyed by activity id, and filled in place"""
+    for n_id in node_info_dict:
+        called_id = node_info_dict[n_id]['called_activity_id']
+        if called_id is None or called_id in sub_activity_infos:
+            continue
+        try:
+            called_activity = all_activities[called_id]
+        except KeyError:
+            raise InvalidModelError(f"Action {node_info_dict[n_id]['name']} calls an unknown activity ({called_id}).")
+        if not is_sub_activity(called_activity):
+            continue
+        print(f'-------- Loading Sub-Activity {called_activity.attrib["name"]} --------')
+        # Register before recursing, so recursive calls see it as already loaded
+        sub_info = {'id': called_id, 'name': called_activity.attrib['name']}
+        sub_activity_infos[called_id] = sub_info
+        sub_info['node_info_dict'], sub_info['edge_info_list'] = load_activity_data(root, called_activity, all_activities, activity_allocations, signal_events)
+        load_sub_activities(root, sub_info['node_info_dict'], all_activities, activity_allocations, signal_events, sub_activity_infos)
+    return sub_activity_infos
+
+
+def load_model_data(xmlfile, ActivityDiagramName):
+    """Extracts all relevant data from the model and organizes it into several containers.
+       sub_activity_infos holds the nodes/edges of every activity called by an action
+       that has its own diagram, keyed by activity id"""
+    tree = ET.parse(xmlfile)
+    root = tree.getroot()
+    activity, all_activities = get_activities(root, ActivityDiagramName)
+    # Actors
+    actor_infos = get_actors(root)
+    activity_allocations = get_actor_allocations(root, actor_infos, all_activities)
+    # Signals
+    signals = get_signals(root)
+    signal_events = get_signal_events(root, signals)
+    # Nodes and Edges
+    node_info_dict, edge_info_list = load_activity_data(root, activity, all_activities, activity_allocations, signal_events)
+    sub_activity_infos = load_sub_activities(root, node_info_dict, all_activities, activity_allocations, signal_events, {})
+    return node_info_dict, edge_info_list, actor_infos, sub_activity_infos